@@ -1,4 +1,6 @@
+import os
 from pathlib import Path
+from unittest.mock import patch
 
 import comm
 from comm import test_utils
@@ -17,6 +19,30 @@ class TestUnit:
         assert comm.dir_name_to_pkg_name(".sample_dir") == "sample_dir"
         assert comm.dir_name_to_pkg_name("sample dir") == "sample_dir"
 
+    def test_template_cache(self, sandbox):
+        templ = Path("test.templ")
+        templ.write_text("a = {{ value }}")
+        comm.render_file(templ, Path("a.py"), {"value": 1})
+        assert comm.get_template(templ) is comm.get_template(templ)
+
+        templ.write_text("b = {{ value }}")
+        os.utime(str(templ), ns=(0, templ.stat().st_mtime_ns + 1))
+        comm.render_file(templ, Path("b.py"), {"value": 2})
+        assert Path("b.py").read_text() == "b = 2"
+
+    def test_batch_format(self, sandbox):
+        templ = Path("test.templ")
+        templ.write_text("x = [ {{ value }} ]")
+
+        with patch("comm.format_py_files", wraps=comm.format_py_files) as format_mock:
+            with comm.batch_format():
+                for v in range(3):
+                    comm.render_py_file(templ, Path(f"f{v}.py"), {"value": v})
+                assert Path("f0.py").read_text() == "x = [ 0 ]"
+
+        format_mock.assert_called_once()
+        assert Path("f2.py").read_text() == "x = [2]\n"
+
 
 class TestSandbox:
     @classmethod
@@ -1,6 +1,5 @@
 from envo.comm import setup_logger
 
 from .env import *  # noqa F401
-from .scripts import *  # noqa F401
 
 setup_logger()
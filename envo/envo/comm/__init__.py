@@ -2,10 +2,26 @@ import importlib.machinery
 import importlib.util
 import inspect
 import sys
+from contextlib import contextmanager
+from functools import lru_cache
 from pathlib import Path
-from typing import Any, Dict
+from typing import TYPE_CHECKING, Any, Dict, Iterator, List, Optional
 
-__all__ = ["dir_name_to_class_name", "setup_logger", "render_py_file", "render_file"]
+if TYPE_CHECKING:
+    from jinja2 import Template
+
+__all__ = [
+    "dir_name_to_class_name",
+    "setup_logger",
+    "render_py_file",
+    "render_file",
+    "get_template",
+    "batch_format",
+    "format_py_files",
+]
+
+# rendered python files waiting to be formatted, None if not batching
+_pending_format: Optional[List[Path]] = None
 
 
 def dir_name_to_class_name(dir_name: str) -> str:
@@ -59,21 +75,74 @@ def setup_logger() -> None:
     )
 
 
-def render_file(template_path: Path, output: Path, context: Dict[str, Any]) -> None:
-    from jinja2 import StrictUndefined, Template
+@lru_cache(maxsize=None)
+def _compile_template(path: Path, mtime_ns: int, strict: bool) -> "Template":
+    from jinja2 import StrictUndefined, Template, Undefined
+
+    return Template(
+        path.read_text(), undefined=StrictUndefined if strict else Undefined
+    )
+
 
-    template = Template(template_path.read_text(), undefined=StrictUndefined)
-    output.write_text(template.render(**context))
+def get_template(template_path: Path, strict: bool = True) -> "Template":
+    """
+    Compiled template, reused until the template file changes.
+
+    :param strict: raise on undefined variables instead of rendering them empty
+    """
+    path = template_path.absolute()
+    return _compile_template(path, path.stat().st_mtime_ns, strict)
+
+
+def render_file(template_path: Path, output: Path, context: Dict[str, Any]) -> None:
+    output.write_text(get_template(template_path).render(**context))
 
 
 def render_py_file(template_path: Path, output: Path, context: Dict[str, Any]) -> None:
+    render_file(template_path, output, context)
+
+    if _pending_format is not None:
+        _pending_format.append(output)
+    else:
+        format_py_files([output])
+
+
+def format_py_files(paths: List[Path]) -> None:
+    """
+    Format files with black in process. Files that can't be parsed are left as they are.
+    """
     import black
 
-    render_file(template_path, output, context)
+    mode = black.FileMode()
+    for p in paths:
+        src = p.read_text()
+        try:
+            dst = black.format_str(src, mode=mode)
+        except black.InvalidInput:
+            continue
+
+        if dst != src:
+            p.write_text(dst)
+
+
+@contextmanager
+def batch_format() -> Iterator[None]:
+    """
+    Defer formatting of files rendered with render_py_file and format them all at once
+    on exit.
+    """
+    global _pending_format
+    if _pending_format is not None:
+        # already batching, outer block formats everything
+        yield
+        return
+
+    _pending_format = []
     try:
-        black.main([str(output), "-q"])
-    except SystemExit:
-        pass
+        yield
+        format_py_files(_pending_format)
+    finally:
+        _pending_format = None
 
 
 def import_module_from_file(path: Path) -> Any:
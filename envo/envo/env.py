@@ -1,11 +1,16 @@
 import inspect
 import os
 from dataclasses import dataclass, field, fields
+from functools import lru_cache
+from itertools import count
 from pathlib import Path
+from types import FunctionType
 from typing import (
     TYPE_CHECKING,
     Any,
+    ClassVar,
     Dict,
+    FrozenSet,
     Generic,
     List,
     Optional,
@@ -18,7 +23,16 @@ from loguru import logger
 
 from envo.comm import import_module_from_file
 
-__all__ = ["BaseEnv", "Env", "Raw", "VenvEnv"]
+__all__ = ["BaseEnv", "Env", "Raw", "VenvEnv", "stage_emoji_mapping"]
+
+
+stage_emoji_mapping: Dict[str, str] = {
+    "comm": "",
+    "test": "🛠",
+    "local": "🐣",
+    "stage": "🤖",
+    "prod": "🔥",
+}
 
 
 T = TypeVar("T")
@@ -39,10 +53,58 @@ class EnvMetaclass(type):
         return cls
 
 
+_epochs = count(1)
+
+
+def _is_skipped(name: str, value: Any) -> bool:
+    """
+    :param value: Attribute as seen through an instance.
+    """
+    return (
+        inspect.ismethod(value)
+        or inspect.isclass(value)
+        or name.startswith("_")
+        or name == "meta"
+    )
+
+
+def _is_skipped_class_attr(name: str, value: Any) -> bool:
+    """
+    :param value: Attribute looked up statically on a class.
+    """
+    # functions and classmethods become methods when accessed through an instance
+    return (
+        isinstance(value, (FunctionType, classmethod))
+        or inspect.isdatadescriptor(value)
+        or _is_skipped(name, value)
+    )
+
+
+@lru_cache(maxsize=None)
+def _get_field_names(cls: type) -> FrozenSet[str]:
+    return frozenset(f.name for f in fields(cls))
+
+
+@lru_cache(maxsize=None)
+def _get_class_var_names(cls: type) -> FrozenSet[str]:
+    """
+    Names of class attributes that count as variables, methods, properties etc. excluded.
+    """
+    return frozenset(
+        n
+        for n in dir(cls)
+        if not _is_skipped_class_attr(n, inspect.getattr_static(cls, n))
+    )
+
+
 class BaseEnv(metaclass=EnvMetaclass):
     class EnvException(Exception):
         pass
 
+    # bumped on every attribute change of any env, cached validation results of older
+    # epochs are stale
+    _mutation_epoch: ClassVar[int] = 0
+
     def __init__(self, name: Optional[str] = None) -> None:
         if name:
             self._name = name
@@ -54,6 +116,14 @@ class BaseEnv(metaclass=EnvMetaclass):
         if not hasattr(self, "_name"):
             self._name = str(self.__class__.__name__)
 
+    def __setattr__(self, name: str, value: Any) -> None:
+        BaseEnv._mutation_epoch = next(_epochs)
+        super().__setattr__(name, value)
+
+    def __delattr__(self, name: str) -> None:
+        BaseEnv._mutation_epoch = next(_epochs)
+        super().__delattr__(name)
+
     def validate(self) -> None:
         errors = self.get_errors(self.get_name())
         if errors:
@@ -61,29 +131,29 @@ class BaseEnv(metaclass=EnvMetaclass):
 
     def get_errors(self, parent_name: str = "") -> List[str]:
         """
+        Results are cached until any env changes.
+
         :param parent_name:
         :return: error messages
         """
-        # look for undeclared variables
-        field_names = set([fie.name for fie in fields(self)])
+        epoch = BaseEnv._mutation_epoch
+        cached = self.__dict__.get("_errors_cache")
+        if cached and cached[0] == epoch and cached[1] == parent_name:
+            return list(cached[2])
 
-        var_names = set()
-        f: str
-        for f in dir(self):
-            attr: Any = getattr(self, f)
+        errors = self._get_errors(parent_name)
+        # bypass __setattr__, caching is not a mutation
+        self.__dict__["_errors_cache"] = (epoch, parent_name, errors)
+        return list(errors)
 
-            if hasattr(self.__class__, f):
-                class_attr: Any = getattr(self.__class__, f)
-            else:
-                class_attr = None
-
-            if (
-                inspect.ismethod(attr)
-                or (class_attr is not None and inspect.isdatadescriptor(class_attr))
-                or f.startswith("_")
-                or inspect.isclass(attr)
-                or f == "meta"
-            ):
+    def _get_errors(self, parent_name: str) -> List[str]:
+        # look for undeclared variables
+        field_names = _get_field_names(self.__class__)
+
+        var_names = set(_get_class_var_names(self.__class__) - self.__dict__.keys())
+        for f, attr in self.__dict__.items():
+            class_attr = inspect.getattr_static(self.__class__, f, None)
+            if _is_skipped(f, attr) or inspect.isdatadescriptor(class_attr):
                 continue
 
             var_names.add(f)
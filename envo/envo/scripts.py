@@ -18,20 +18,13 @@ from xonsh.ptk_shell.shell import PromptToolkitShell
 
 from envo import Env, comm
 from envo.comm import import_module_from_file
+from envo.env import stage_emoji_mapping
 
 __all__ = ["stage_emoji_mapping"]
 
 package_root = Path(os.path.realpath(__file__)).parent
 templates_dir = package_root / "templates"
 
-stage_emoji_mapping: Dict[str, str] = {
-    "comm": "",
-    "test": "🛠",
-    "local": "🐣",
-    "stage": "🤖",
-    "prod": "🔥",
-}
-
 
 class Shell(PromptToolkitShell):  # type: ignore
     def __init__(self, execer: Execer) -> None:
@@ -1,4 +1,6 @@
 import os
+import time
+from functools import partial
 from pathlib import Path
 
 import pytest
@@ -222,3 +224,62 @@ class TestParentChild:
 
         assert "child_bin_dir" in os.environ["PATH"]
         assert "parent_bin_dir" in os.environ["PATH"]
+
+
+class TestValidation:
+    class Leaf(envo.BaseEnv):
+        value: int
+
+        def __init__(self) -> None:
+            super().__init__()
+            self.value = 1
+
+        def double(self) -> int:
+            return self.value * 2
+
+    class Node(envo.BaseEnv):
+        left: envo.BaseEnv
+        right: envo.BaseEnv
+
+        def __init__(self, depth: int) -> None:
+            super().__init__()
+            child_type = (
+                partial(TestValidation.Node, depth - 1)
+                if depth > 1
+                else TestValidation.Leaf
+            )
+            self.left = child_type()
+            self.right = child_type()
+
+        @property
+        def prop(self) -> str:
+            return "prop"
+
+    def test_validate_unchanged(self):
+        tree = self.Node(depth=9)
+
+        start = time.perf_counter()
+        tree.validate()
+        first = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in range(100):
+            tree.validate()
+        cached = time.perf_counter() - start
+
+        assert cached < first
+
+    def test_validate_after_change(self):
+        tree = self.Node(depth=3)
+        tree.validate()
+
+        leaf = tree.left.left.right
+        del leaf.value
+        with pytest.raises(envo.BaseEnv.EnvException) as exc:
+            tree.validate()
+        assert str(exc.value) == (
+            'Detected errors!\nVariable "Node.left.left.right.value" is unset!'
+        )
+
+        leaf.value = 2
+        tree.validate()
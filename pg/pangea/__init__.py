@@ -1,3 +1,7 @@
+from loguru import logger
+
 from pangea.comm import setup_logger
+from pangea.devops import prefix_log_record
 
 setup_logger()
+logger.configure(patcher=prefix_log_record)
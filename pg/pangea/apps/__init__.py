@@ -1,18 +1,19 @@
+import hashlib
+import json
 import os
+import threading
 from dataclasses import dataclass
-from datetime import datetime
 from pathlib import Path
-from typing import TYPE_CHECKING, Any, Dict, Optional, Type
+from typing import TYPE_CHECKING, Any, Dict, Optional, Sequence, Set
 
-from jinja2 import Template
 from loguru import logger
 
 import environ
 from envo import Env, Raw
 from pangea import comm
-from pangea.devops import run
+from pangea.devops import CommandError, run
 from pangea.env import ClusterEnv
-from pangea.kube import Namespace
+from pangea.kube import HelmRelease, Namespace
 
 if TYPE_CHECKING:
     from pangea.cluster import Cluster
@@ -93,6 +94,28 @@ class App:
         logger.info(f'Preparing app "{self.env.get_name()}"')
 
 
+_logged_in_registries: Set[str] = set()
+_login_lock = threading.Lock()
+
+
+def registry_login(registry_env: ClusterEnv.Registry) -> None:
+    """
+    Log in to a docker registry. Done once per registry for the whole session.
+    """
+    with _login_lock:
+        if registry_env.address in _logged_in_registries:
+            return
+
+        run(
+            f"""
+            docker login {registry_env.address} \\
+            --username {registry_env.username} -p{registry_env.password}
+            """,
+            print_output=False,
+        )
+        _logged_in_registries.add(registry_env.address)
+
+
 class Image:
     @dataclass
     class Sets:
@@ -107,15 +130,40 @@ class Image:
         self.se = se
 
     def push(self) -> None:
-        env = self.li.registry_env
-        run(
-            f"""
-            docker login {env.address} \\
-            --username {env.username} -p{env.password}
-            docker push {self.se.tag}
-            """,
-            print_output=False,
-        )
+        registry_login(self.li.registry_env)
+        run(f"docker push {self.se.tag}", print_output=False)
+
+    def pull(self) -> None:
+        registry_login(self.li.registry_env)
+        run(f"docker pull {self.se.tag}", print_output=False)
+
+    def exists(self) -> bool:
+        """
+        Check if the tag is already in the registry.
+        """
+        registry_login(self.li.registry_env)
+        try:
+            run(f"docker manifest inspect --insecure {self.se.tag}")
+        except CommandError:
+            return False
+
+        return True
+
+    def get_digest(self) -> str:
+        """
+        Hash of the registry manifest the tag points to, changes when the tag is moved.
+        """
+        registry_login(self.li.registry_env)
+        manifest = run(f"docker manifest inspect --insecure {self.se.tag}")
+        return hashlib.sha256("\n".join(manifest).encode("utf-8")).hexdigest()
+
+    def exists_locally(self) -> bool:
+        try:
+            run(f"docker image inspect {self.se.tag}")
+        except CommandError:
+            return False
+
+        return True
 
 
 class Dockerfile:
@@ -134,15 +182,30 @@ class Dockerfile:
         self.li = li
         self.se = se
 
-    def render(self):
-        template = Template(self.se.template.read_text())
+    def get_content(self) -> str:
         context = {"env": self.li.app_env, "base_image": f"{self.se.base_image}"}
-        self.se.out_path.write_text(template.render(**context))
+        # user templates may reference env fields that are not set
+        return comm.get_template(self.se.template, strict=False).render(**context)
+
+    def render(self) -> bool:
+        """
+        :return: True if the Dockerfile changed
+        """
+        content = self.get_content()
+        if self.se.out_path.exists() and self.se.out_path.read_text() == content:
+            return False
+
+        self.se.out_path.write_text(content)
+        return True
+
+    @property
+    def context_dir(self) -> Path:
+        return self.li.cluster_env.root
 
     def build(self, tag: str):
         run(
             f"""
-            docker build -f {str(self.se.out_path)} -t {tag} {str(self.li.cluster_env.root)}
+            docker build -f {str(self.se.out_path)} -t {tag} {str(self.context_dir)}
             """,
             print_output=False,
         )
@@ -153,6 +216,149 @@ class Dockerfile:
         )
 
 
+class ImageBuilder:
+    """
+    Builds and pushes images tagged with a hash of the rendered Dockerfile and the build context.
+
+    Builds whose tag was built before, according to the local index or the registry, are
+    skipped. Builds can be started from many threads, at most se.workers of them run at
+    the same time.
+    """
+
+    @dataclass
+    class Sets:
+        workers: int
+        index_file: Path
+
+    @dataclass
+    class Links:
+        registry_env: ClusterEnv.Registry
+
+    def __init__(self, se: Sets, li: Links) -> None:
+        self.se = se
+        self.li = li
+
+        self._slots = threading.BoundedSemaphore(self.se.workers)
+        self._context_hashes: Dict[Path, str] = {}
+        self._lock = threading.Lock()
+
+    def get_hash(
+        self,
+        dockerfile: Dockerfile,
+        context_dir: Optional[Path] = None,
+        base_digest: str = "",
+    ) -> str:
+        """
+        :param context_dir: Directory hashed along with the Dockerfile, build context if None.
+        :param base_digest: Digest of the base image, for bases moved between builds.
+        """
+        context_hash = self._get_context_hash(context_dir or dockerfile.context_dir)
+
+        sha256 = hashlib.sha256(dockerfile.get_content().encode("utf-8"))
+        sha256.update(context_hash.encode("utf-8"))
+        sha256.update(base_digest.encode("utf-8"))
+        return sha256.hexdigest()[:16]
+
+    def _get_context_hash(self, context_dir: Path) -> str:
+        # the same context is shared by many dockerfiles, hash it once per session
+        with self._lock:
+            if context_dir not in self._context_hashes:
+                self._context_hashes[context_dir] = hash_dir(context_dir)
+            return self._context_hashes[context_dir]
+
+    def is_built(self, image: Image) -> bool:
+        if image.se.tag in self._read_index()["built"]:
+            return True
+
+        if image.exists():
+            self.mark_built(image)
+            return True
+
+        return False
+
+    def mark_built(self, image: Image) -> None:
+        with self._lock:
+            index = self._read_index()
+            index["built"] = sorted(set(index["built"]) | {image.se.tag})
+            self._write_index(index)
+
+    def clear_index(self) -> None:
+        """
+        Forget built images, for example after the registry was recreated.
+        """
+        with self._lock:
+            self.se.index_file.unlink(missing_ok=True)
+
+    def _read_index(self) -> Dict[str, Any]:
+        if not self.se.index_file.exists():
+            return {"built": []}
+
+        index: Dict[str, Any] = json.loads(self.se.index_file.read_text())
+        return index
+
+    def _write_index(self, index: Dict[str, Any]) -> None:
+        self.se.index_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.se.index_file.with_suffix(".tmp")
+        tmp.write_text(json.dumps(index, indent=4, sort_keys=True))
+        os.replace(str(tmp), str(self.se.index_file))
+
+    def build(
+        self, dockerfile: Dockerfile, repository: str, aliases: Sequence[str] = ()
+    ) -> Image:
+        """
+        :param repository: Image name without a tag.
+        :param aliases: Extra tags pointed at the image, also when the build is skipped.
+        """
+        image = Image(
+            se=Image.Sets(tag=f"{repository}:{self.get_hash(dockerfile)}"),
+            li=Image.Links(registry_env=self.li.registry_env),
+        )
+
+        with self._slots:
+            if self.is_built(image):
+                logger.info(f"{image.se.tag} is up to date, skipping build")
+            else:
+                dockerfile.render()
+                dockerfile.build(image.se.tag)
+                image.push()
+                self.mark_built(image)
+
+            # aliases might point to another build, e.g. after a change was reverted
+            if aliases and not image.exists_locally():
+                image.pull()
+
+            for a in aliases:
+                alias = Image(
+                    se=Image.Sets(tag=f"{repository}:{a}"),
+                    li=Image.Links(registry_env=self.li.registry_env),
+                )
+                run(f"docker tag {image.se.tag} {alias.se.tag}")
+                alias.push()
+
+        return image
+
+
+def hash_dir(root: Path) -> str:
+    """
+    Hash paths and contents of files in a directory. Hidden files and directories are skipped.
+    """
+    sha256 = hashlib.sha256()
+
+    for p in sorted(root.rglob("*")):
+        rel = p.relative_to(root)
+        if not p.is_file() or any(
+            part.startswith(".") or part == "__pycache__" for part in rel.parts
+        ):
+            continue
+
+        sha256.update(str(rel).encode("utf-8"))
+        with p.open("rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                sha256.update(chunk)
+
+    return sha256.hexdigest()
+
+
 class DockerUtils:
     @dataclass
     class Sets:
@@ -287,40 +493,39 @@ class SkaffoldApp(App):
     dockerfile: Dockerfile
     skaffold_file: Path
 
-    def __init__(self, Env: Type[SkaffoldAppEnv], ClusterEnv: Type[ClusterEnv]) -> None:
-        super().__init__(Env=Env)
-        self.cluster_env = ClusterEnv.get_current_stage()
+    def __init__(self, cluster: "Cluster", namespace: "Namespace", env: AppEnv) -> None:
+        super().__init__(cluster=cluster, namespace=namespace, env=env)
+        self.cluster_env = self.cluster.env
 
+        # absolute paths, apps are prepared and deployed from many threads
         self.dockerfile = Dockerfile(
             se=Dockerfile.Sets(
                 template=self.env.dockerfile_templ,
-                out_path=Path(f"Dockerfile.{self.env.stage}"),
+                out_path=self.env.root / f"Dockerfile.{self.env.stage}",
                 base_image=self.env.base_image,
             ),
             li=Dockerfile.Links(app_env=self.env, cluster_env=self.cluster_env),
         )
 
-        self.skaffold_file = Path(f"skaffold.{self.env.stage}.yaml")
+        self.skaffold_file = self.env.root / f"skaffold.{self.env.stage}.yaml"
 
     def prepare(self) -> None:
         super().prepare()
-        logger.info(f"Prebuilding {self.li.env.app_name}...")
-        os.chdir(str(self.li.env.root))
-        env = self.li.env
+        logger.info(f"Prebuilding {self.env.app_name}...")
         dockerfile = Dockerfile(
             se=Dockerfile.Sets(
                 template=self.dockerfile.se.template,
                 out_path=Path(f"{self.dockerfile.se.out_path}.prebuild"),
-                base_image=env.src_image,
+                base_image=self.env.src_image,
             ),
-            li=Dockerfile.Links(app_env=self.env, cluster_env=self.li.cluster_env),
+            li=Dockerfile.Links(app_env=self.env, cluster_env=self.cluster_env),
+        )
+        self.cluster.image_builder.build(
+            dockerfile, repository=self.env.prebuild_image_name, aliases=["latest"]
         )
-        dockerfile.render()
-        image = dockerfile.build(tag=env.prebuild_image_name)
-        image.push()
 
     def render(self, extra_context: Dict[str, Any] = None) -> None:
-        self.chdir_to_root()
+        from jinja2 import Template
 
         self.dockerfile.render()
 
@@ -341,32 +546,72 @@ class SkaffoldApp(App):
         super().deploy()
         self.render()
 
-        registry = self.env.cluster.registry
-        logger.info("Building and deploying using skaffold.")
-
-        os.environ["PL_IMAGE_NAME"] = self.env.image_name
-        image_tag: str = datetime.now().strftime("%Y-%m-%d_%H_%M_%S")
-        os.environ["PL_IMAGE_TAG"] = image_tag
+        builder = self.cluster.image_builder
+        registry = self.cluster_env.registry
 
-        image = f"{self.env.image_name}:{image_tag}"
+        # prebuild image is rebuilt under the same tag
+        base_image = Image(
+            se=Image.Sets(tag=self.dockerfile.se.base_image),
+            li=Image.Links(registry_env=registry),
+        )
+        image_tag = builder.get_hash(
+            self.dockerfile,
+            context_dir=self.env.src,
+            base_digest=base_image.get_digest(),
+        )
+        image = Image(
+            se=Image.Sets(tag=f"{self.env.image_name}:{image_tag}"),
+            li=Image.Links(registry_env=registry),
+        )
 
+        # image and everything rolled out along with it
+        fingerprint = hashlib.sha256(
+            "\n".join(
+                [
+                    image.se.tag,
+                    self.skaffold_file.read_text(),
+                    (self.env.root / f"values.{self.env.stage}.yaml").read_text(),
+                ]
+            ).encode("utf-8")
+        ).hexdigest()
+
+        # kept in the namespace so it's gone along with whatever was deployed there
+        fingerprint_key = f"skaffold.{self.name}"
+        if HelmRelease.skip_unchanged:
+            if self.namespace.get_fingerprints().get(fingerprint_key) == fingerprint:
+                logger.info(f"{self.name} is unchanged, skipping deploy")
+                return
+
+        if builder.is_built(image):
+            logger.info(f"{image.se.tag} is up to date, skipping build")
+        else:
+            logger.info("Building using skaffold.")
+            registry_login(registry)
+            # passed per command, os.environ is shared by apps deployed concurrently
+            run(
+                f"""
+                PL_IMAGE_NAME={self.env.image_name} PL_IMAGE_TAG={image_tag} \\
+                skaffold build -f {str(self.skaffold_file)} --insecure-registry {registry.address}
+                docker push {image.se.tag}
+                """,
+                print_output=True,
+            )
+            builder.mark_built(image)
+
+        logger.info("Deploying using skaffold.")
         run(
-            f"""
-            docker login {registry.address} --username {registry.username} -p{registry.password}
-            skaffold build -f {str(self.skaffold_file)} --insecure-registry {registry.address}
-            docker push {image}
-            skaffold deploy -f {str(self.skaffold_file)} --images {image}
-            """,
+            f"skaffold deploy -f {str(self.skaffold_file)} --images {image.se.tag}",
             print_output=True,
         )
+        self.namespace.save_fingerprint(fingerprint_key, fingerprint)
 
     def dev(self) -> None:
         self.render({"dev": True})
-        registry = self.env.cluster.registry
+        registry = self.cluster_env.registry
 
+        registry_login(registry)
         run(
             f"""
-            docker login {registry.address} --username {registry.username} -p{registry.password}
             skaffold dev -f {str(self.skaffold_file)} --verbosity debug
             """,
             print_output=True,
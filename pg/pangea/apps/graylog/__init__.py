@@ -1,8 +1,8 @@
-import os
 from dataclasses import dataclass
 
 from loguru import logger
 
+from pangea import dumps, profiler
 from pangea.apps import App
 
 
@@ -18,45 +18,58 @@ class Graylog(App):
     def __init__(self, se: Sets, li: Links):
         super().__init__(se, li)
 
-    def seed(self) -> None:
-        os.chdir(str(self.se.root))
-
-        logger.info("🌱Seeding graylog")
+        self.dump_file = self.se.root / "dump.archive.gz"
 
+    def _get_mongo_pod(self) -> str:
         mongo_pod: str = self.li.namespace.kubectl(
             "get pods -l app=mongodb-replicaset "
             '-o name | grep -m 1 -o "graylog-graylog-mongodb.*$"'
         )[0]
-        self.li.namespace.kubectl(
-            f'exec {mongo_pod} -- bash -c "mkdir -p /home/restore"'
-        )
-        self.li.namespace.kubectl(f"cp dump {mongo_pod}:home/restore/graylog")
-        self.li.namespace.kubectl(
-            f'exec {mongo_pod} -- bash -c "mongorestore --quiet /home/restore"'
-        )
+        return mongo_pod
+
+    @profiler.profiled
+    def seed(self) -> None:
+        logger.info("🌱Seeding graylog")
+
+        mongo_pod = self._get_mongo_pod()
+
+        if self.dump_file.exists():
+            dumps.restore(
+                self.li.namespace.name,
+                mongo_pod,
+                "mongorestore --quiet --archive",
+                self.dump_file,
+            )
+        else:
+            # dump directory from before streaming dumps
+            self.li.namespace.kubectl(
+                f'exec {mongo_pod} -- bash -c "mkdir -p /home/restore"'
+            )
+            self.li.namespace.kubectl(
+                f"cp {self.se.root / 'dump'} {mongo_pod}:home/restore/graylog"
+            )
+            self.li.namespace.kubectl(
+                f'exec {mongo_pod} -- bash -c "mongorestore --quiet /home/restore"'
+            )
 
         logger.info("👌Seeding graylog done")
 
     def dump_data(self) -> None:
-        os.chdir(str(self.se.root))
-
         logger.info("♻️Dumping graylog♻")
 
-        mongo_pod: str = self.li.namespace.kubectl(
-            "get pods -l app=mongodb-replicaset "
-            '-o name | grep -m 1 -o "graylog-graylog-mongodb.*$"'
-        )[0]
-        self.li.namespace.kubectl(
-            f'exec {mongo_pod} -- bash -c "mongodump --quiet -d graylog -o /home/dumps"'
+        dumps.dump(
+            self.li.namespace.name,
+            self._get_mongo_pod(),
+            "mongodump --quiet --archive -d graylog",
+            self.dump_file,
         )
-        self.li.namespace.kubectl(f"cp {mongo_pod}:home/dumps/graylog dump")
         logger.info("♻️Dumping graylog done\n")
 
     def deploy(self) -> None:
         super().deploy()
 
         self.li.namespace.helm("graylog").install("stable/graylog", "1.3.9")
-        self.li.namespace.kubectl("apply -f k8s/fluentbit-configmap.yaml")
+        self.li.namespace.apply_yaml(str(self.se.root / "k8s/fluentbit-configmap.yaml"))
         self.li.namespace.helm("fluentbit").install("stable/fluent-bit", "2.8.2")
         self.seed()
 
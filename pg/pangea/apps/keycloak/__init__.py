@@ -1,9 +1,9 @@
-import os
 from dataclasses import dataclass
 from typing import Optional
 
 from loguru import logger
 
+from pangea import profiler
 from pangea.apps import App
 from pangea.apps.postgres import Postgres
 from pangea.devops import run
@@ -41,23 +41,24 @@ class Keycloak(App):
         self.li.namespace.helm(self.se.name).delete()
 
     def dump(self) -> None:
-        os.chdir(str(self.se.root))
-
         logger.info("Dumping keycloak database.")
 
         # TODO: put those credentials to env
-        self.li.postgres.master.exec(
-            "PGUSER=keycloak PGPASSWORD=password pg_dump -d keycloak > /tmp/dump.sql"
+        self.li.postgres.master.dump(
+            "PGUSER=keycloak PGPASSWORD=password pg_dump -d keycloak",
+            self.se.root / "dumps/dump.sql.gz",
         )
-        self.li.postgres.master.copy_from_pod("/tmp/dump.sql", "dumps/dump.sql")
         logger.info("Dumped.")
 
+    @profiler.profiled
     def seed(self) -> None:
-        os.chdir(str(self.se.root))
-
         logger.info("Restoring keycloak database from dump.")
 
-        self.li.postgres.master.copy_to_pod("dumps/dump.sql", "/tmp/dump.sql")
+        dump = self.se.root / "dumps/dump.sql.gz"
+        if not dump.exists():
+            # uncompressed dump from before streaming dumps
+            dump = self.se.root / "dumps/dump.sql"
+
         self.li.namespace.kubectl(
             f"scale --replicas=0 -n aux statefulset {self.se.name}"
         )
@@ -68,8 +69,8 @@ class Keycloak(App):
         self.li.postgres.master.exec(
             "PGUSER=postgres PGPASSWORD=password createdb keycloak"
         )
-        self.li.postgres.master.exec(
-            "PGUSER=keycloak PGPASSWORD=password psql keycloak -f /tmp/dump.sql"
+        self.li.postgres.master.restore(
+            "PGUSER=keycloak PGPASSWORD=password psql keycloak", dump
         )
         self.li.namespace.kubectl(
             f"scale --replicas=1 -n aux statefulset {self.se.name}"
@@ -21,8 +21,10 @@ class Postgres(App):
 
     def deploy(self) -> None:
         super().deploy()
-        self.li.namespace.apply_yaml("k8s/secret.yaml")
-        self.li.namespace.apply_yaml("k8s/configmap.yaml")
+        self.li.namespace.apply_yaml(
+            str(self.se.root / "k8s/secret.yaml"),
+            str(self.se.root / "k8s/configmap.yaml"),
+        )
         self.release.install(chart="stable/postgresql", version="6.3.7")
 
     def delete(self) -> None:
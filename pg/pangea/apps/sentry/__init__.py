@@ -1,8 +1,8 @@
-import os
 from dataclasses import dataclass
 
 from loguru import logger
 
+from pangea import dumps, profiler
 from pangea.apps import App
 
 
@@ -19,33 +19,40 @@ class Sentry(App):
         super().__init__(se, li)
 
     def dump_data(self) -> None:
-        os.chdir(str(self.se.root))
-
         logger.info("♻️Dumping sentry")
 
         namespace = self.li.namespace
         sentry_pod: str = namespace.kubectl(
             'get pods -l role=web -o name | grep -m 1 -o "sentry-web.*$"'
         )[0]
-        namespace.kubectl(
-            f'exec {sentry_pod} -- bash -c "sentry export --silent --indent=2 '
-            f'--exclude migrationhistory,permission,savedsearch,contenttype > /home/sentry/dump.json"'
+        dumps.dump(
+            namespace.name,
+            sentry_pod,
+            "sentry export --silent --indent=2 "
+            "--exclude migrationhistory,permission,savedsearch,contenttype",
+            self.se.root / "dump.json.gz",
         )
-        namespace.kubectl(f"cp {sentry_pod}:home/sentry/dump.json dump.json")
         logger.info("♻️Dumping sentry done\n")
 
+    @profiler.profiled
     def seed(self) -> None:
-        os.chdir(str(self.se.root))
-
         logger.info("🌱Seeding sentry")
 
         namespace = self.li.namespace
         sentry_pod: str = namespace.kubectl(
             'get pods -l role=web -o name | grep -m 1 -o "sentry-web.*$"'
         )[0]
-        namespace.kubectl(f"cp dump.json {sentry_pod}:home/sentry/dump.json")
-        namespace.kubectl(
-            f'exec {sentry_pod} -- bash -c "sentry django loaddata /home/sentry/dump.json"'
+        dump = self.se.root / "dump.json.gz"
+        if not dump.exists():
+            # uncompressed dump from before streaming dumps
+            dump = self.se.root / "dump.json"
+
+        # loaddata can't read stdin
+        dumps.restore(
+            namespace.name,
+            sentry_pod,
+            "cat > /home/sentry/dump.json && sentry django loaddata /home/sentry/dump.json",
+            dump,
         )
 
         logger.info("👌Seeding sentry done")
@@ -0,0 +1,147 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Dict, Iterator
+
+from loguru import logger
+
+import environ
+
+environ = environ.Env()
+
+__all__ = ["DownloadCache", "get_default"]
+
+
+class DownloadCache:
+    """
+    Content addressed store of downloaded artifacts shared by all clusters.
+
+    Blobs are stored under their sha256. The index maps artifact keys (name and version)
+    to blob hashes, sizes and last use times which are used for LRU eviction.
+    """
+
+    @dataclass
+    class Sets:
+        root: Path
+        max_size: int
+
+    def __init__(self, se: Sets) -> None:
+        self.se = se
+
+        self.blobs_dir = self.se.root / "blobs"
+        self.index_file = self.se.root / "index.json"
+        self.lock_file = self.se.root / ".lock"
+
+        self.blobs_dir.mkdir(parents=True, exist_ok=True)
+
+        self._lock = threading.Lock()
+
+    def get(self, key: str, dst: Path) -> bool:
+        """
+        Place cached artifact at dst.
+
+        :return: False if the artifact is not cached or its blob is corrupted
+        """
+        with self._locked_index() as index:
+            entry = index.get(key)
+            if not entry:
+                return False
+
+            blob = self.blobs_dir / entry["sha256"]
+            if not blob.exists() or self._hash(blob) != entry["sha256"]:
+                logger.warning(f"Cached {key} is corrupted, dropping it")
+                blob.unlink(missing_ok=True)
+                del index[key]
+                return False
+
+            entry["last_used"] = time.time()
+            self._place(blob, dst)
+
+        return True
+
+    def put(self, key: str, src: Path) -> None:
+        sha256 = self._hash(src)
+        blob = self.blobs_dir / sha256
+
+        with self._locked_index() as index:
+            if not blob.exists():
+                tmp = self.blobs_dir / f".{sha256}.tmp"
+                tmp.unlink(missing_ok=True)
+                self._place(src, tmp)
+                os.replace(str(tmp), str(blob))
+
+            index[key] = {
+                "sha256": sha256,
+                "size": blob.stat().st_size,
+                "last_used": time.time(),
+            }
+            self._evict(index)
+
+    def _evict(self, index: Dict[str, Any]) -> None:
+        blob_sizes = {e["sha256"]: e["size"] for e in index.values()}
+        size = sum(blob_sizes.values())
+
+        for key, entry in sorted(index.items(), key=lambda i: i[1]["last_used"]):
+            if size <= self.se.max_size:
+                break
+
+            logger.debug(f"Evicting {key} from download cache")
+            del index[key]
+
+            # blob might still be used by other keys
+            if entry["sha256"] in (e["sha256"] for e in index.values()):
+                continue
+
+            (self.blobs_dir / entry["sha256"]).unlink(missing_ok=True)
+            size -= entry["size"]
+
+    @contextmanager
+    def _locked_index(self) -> Iterator[Dict[str, Any]]:
+        # thread lock for concurrent installs, file lock for other processes
+        with self._lock, self.lock_file.open("w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            index: Dict[str, Any] = {}
+            if self.index_file.exists():
+                index = json.loads(self.index_file.read_text())
+
+            yield index
+
+            tmp = self.index_file.with_suffix(".tmp")
+            tmp.write_text(json.dumps(index, indent=4, sort_keys=True))
+            os.replace(str(tmp), str(self.index_file))
+
+    @staticmethod
+    def _place(src: Path, dst: Path) -> None:
+        try:
+            os.link(str(src), str(dst))
+        except OSError:
+            # different filesystems
+            shutil.copy2(str(src), str(dst))
+
+    @staticmethod
+    def _hash(path: Path) -> str:
+        sha256 = hashlib.sha256()
+        with path.open("rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                sha256.update(chunk)
+
+        return sha256.hexdigest()
+
+
+@lru_cache()
+def get_default() -> DownloadCache:
+    return DownloadCache(
+        DownloadCache.Sets(
+            root=Path(environ.str("PG_CACHE_DIR", str(Path.home() / ".pangea/cache"))),
+            max_size=environ.int("PG_CACHE_SIZE_MB", 2048) * 1024 * 1024,
+        )
+    )
@@ -1,22 +1,24 @@
 import shutil
-import time
 import typing
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack
+from functools import partial
 from importlib import import_module
+from itertools import groupby
 from pathlib import Path
 from typing import Dict, List, Tuple
 
 from loguru import logger
 
 import environ
-import fire
 from envo import stage_emoji_mapping
-from pangea import apps, comm, deps, devices, pkg_vars
+from pangea import apps, comm, deps, devices, pkg_vars, profiler
 from pangea.apps import App
 from pangea.deps import DnsServer
-from pangea.devops import run
+from pangea.devops import WaitTimeout, prefixed_output, run
 from pangea.env import ClusterEnv
-from pangea.kube import Kube, Namespace
+from pangea.kube import ApiBackend, HelmRelease, Kube, Namespace
 
 environ = environ.Env()
 
@@ -36,6 +38,7 @@ class Cluster:
     namespaces: typing.OrderedDict[str, Namespace]
     deps: List[deps.Dependency]
     python: apps.PythonUtils
+    image_builder: apps.ImageBuilder
     system: Namespace
 
     def __init__(self, env: ClusterEnv) -> None:
@@ -44,6 +47,9 @@ class Cluster:
 
         self.device = devices.all[self.env.device.type](self.env)
 
+        if environ.str("PG_KUBE_BACKEND", "kubectl") == "api":
+            Kube.backend = ApiBackend(ApiBackend.Sets(kubeconfig=self.env.kubeconfig))
+
         self.dns_server = DnsServer(
             DnsServer.Sets(
                 deps_dir=self.env.deps_dir, version=self.env.deps.dns_server_ver
@@ -74,6 +80,14 @@ class Cluster:
             self.dns_server,
         ]
 
+        self.image_builder = apps.ImageBuilder(
+            se=apps.ImageBuilder.Sets(
+                workers=environ.int("PG_BUILD_WORKERS", 4),
+                index_file=self.env.deps_dir / f"images.{self.env.stage}.json",
+            ),
+            li=apps.ImageBuilder.Links(registry_env=self.env.registry),
+        )
+
         self.namespaces = OrderedDict()
 
         self.python = apps.PythonUtils(
@@ -94,6 +108,8 @@ class Cluster:
     def handle_command(cls) -> None:
         current_cluster = cls.get_current_cluster()
         try:
+            import fire
+
             fire.Fire(current_cluster)
         except Cluster.ClusterException as exc:
             logger.error(exc)
@@ -127,24 +143,29 @@ class Cluster:
             "namespace": namespace,
         }
 
-        comm.render_py_file(
-            app_dir / "templates/env_comm.py.templ",
-            app_instance_dir / "env_comm.py",
-            context=context_base,
-        )
-
-        for s in ["local", "test", "stage", "prod"]:
+        with comm.batch_format():
             comm.render_py_file(
-                app_dir / f"templates/env.py.templ",
-                app_instance_dir / f"env_{s}.py",
-                context={"stage": s, "emoji": stage_emoji_mapping[s], **context_base},
+                app_dir / "templates/env_comm.py.templ",
+                app_instance_dir / "env_comm.py",
+                context=context_base,
             )
 
-        comm.render_py_file(
-            app_dir / "templates/app.py.templ",
-            app_instance_dir / "app.py",
-            context={**context_base},
-        )
+            for s in ["local", "test", "stage", "prod"]:
+                comm.render_py_file(
+                    app_dir / f"templates/env.py.templ",
+                    app_instance_dir / f"env_{s}.py",
+                    context={
+                        "stage": s,
+                        "emoji": stage_emoji_mapping[s],
+                        **context_base,
+                    },
+                )
+
+            comm.render_py_file(
+                app_dir / "templates/app.py.templ",
+                app_instance_dir / "app.py",
+                context={**context_base},
+            )
 
         shutil.copy(app_dir / "values.yaml", app_instance_dir / "values.yaml")
 
@@ -172,36 +193,125 @@ class Cluster:
                 self.namespaces[namespace_name] = Namespace(name=namespace_name)
 
             namespace = self.namespaces[namespace_name]
-            app_env = import_module(
-                f"{self.env.get_name()}.{a}.env_comm"
-            ).Env.get_stage(self.env.stage)
-            app = import_module(f"{self.env.get_name()}.{a}.app").App(
-                cluster=self, namespace=namespace, env=app_env
-            )
-            namespace.add_app(app)
+            namespace.add_app_loader(app_name, partial(self._load_app, namespace, a))
+
+    def _load_app(self, namespace: Namespace, app_path: str) -> App:
+        """
+        :param app_path: "<namespace>.<app>"
+        """
+        app_env = import_module(
+            f"{self.env.get_name()}.{app_path}.env_comm"
+        ).Env.get_stage(self.env.stage)
+        app: App = import_module(f"{self.env.get_name()}.{app_path}.app").App(
+            cluster=self, namespace=namespace, env=app_env
+        )
+        return app
 
-    def prepare_all(self) -> None:
-        for n in self.namespaces.values():
-            for a in n.apps.values():
-                a.prepare()
+    def __getattr__(self, name: str) -> Namespace:
+        # lets fire reach namespaces as cluster attributes
+        namespaces = self.__dict__.get("namespaces", {})
+        if name in namespaces:
+            namespace: Namespace = namespaces[name]
+            return namespace
+
+        raise AttributeError(name)
 
-    def deploy(self) -> None:
+    def prepare_all(self) -> None:
+        """
+        Prepare apps concurrently. Image builds are limited by image_builder workers.
+        """
+        all_apps = list(self.get_apps().values())
+
+        def prepare_app(app: App) -> None:
+            with prefixed_output(f"[{app.name}] " if len(all_apps) > 1 else ""):
+                app.prepare()
+
+        with ThreadPoolExecutor(max_workers=max(len(all_apps), 1)) as executor:
+            for f in as_completed([executor.submit(prepare_app, a) for a in all_apps]):
+                f.result()
+
+    def deploy(
+        self, fail_fast: bool = True, workers: int = 4, changed_only: bool = False
+    ) -> None:
+        """
+        Deploy apps in waves of the same deploy priority. Apps within a wave are deployed concurrently.
+
+        :param fail_fast: Stop on the first failure. Otherwise deploy the rest and report failures at the end.
+        :param workers: Maximum number of apps deployed at the same time.
+        :param changed_only: Skip helm releases whose chart, version and values didn't change since the last deploy.
+            Skaffold apps are skipped when their image, skaffold file and values didn't change.
+        """
         logger.info(f'Deploying to "{self.env.stage}" 🚀')
+        with profiler.span("deploy"):
+            self._deploy(fail_fast, workers, changed_only)
+
+        logger.info(f"All done 👌")
+
+    def _deploy(self, fail_fast: bool, workers: int, changed_only: bool) -> None:
         run("helm repo update")
 
         if not self.dns_server.is_running():
             self.dns_server.start()
 
-        for n in self.namespaces.values():
-            n.create()
+        failed: List[str] = []
 
-        a: App
-        for a in self.get_apps().values():
-            a.deploy()
+        with ExitStack() as stack:
+            stack.enter_context(Kube.cached_state())
+            if changed_only:
+                stack.enter_context(HelmRelease.skipping_unchanged())
+
+            for n in self.namespaces.values():
+                n.create()
+                stack.enter_context(n.batch())
+
+            for wave in self._get_deploy_waves():
+                failed += self._deploy_wave(wave, fail_fast=fail_fast, workers=workers)
+                # next wave might depend on manifests of this one
+                for n in self.namespaces.values():
+                    n.flush()
+
+        if failed:
+            raise self.ClusterException(f"Failed to deploy {', '.join(failed)} 😓")
 
         self.add_hosts()
 
-        logger.info(f"All done 👌")
+    def _get_deploy_waves(self) -> List[List[App]]:
+        return [
+            list(wave)
+            for _, wave in groupby(
+                self.get_apps().values(), key=lambda a: a.env.deploy_priority
+            )
+        ]
+
+    def _deploy_wave(self, wave: List[App], fail_fast: bool, workers: int) -> List[str]:
+        """
+        :return: names of apps that failed to deploy
+        """
+
+        def deploy_app(app: App) -> None:
+            with prefixed_output(f"[{app.name}] " if len(wave) > 1 else ""):
+                with profiler.span(f"deploy {app.name}"):
+                    app.deploy()
+
+        failed: List[str] = []
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(deploy_app, a): a for a in wave}
+            for f in as_completed(futures):
+                exc = f.exception()
+                if not exc:
+                    continue
+
+                if fail_fast:
+                    for pending in futures:
+                        pending.cancel()
+                    raise exc
+
+                app = futures[f]
+                logger.error(f'Deploying "{app.name}" failed: {exc}')
+                failed.append(app.name)
+
+        return failed
 
     def add_hosts(self) -> None:
         logger.info("Adding hosts to the dns server")
@@ -215,38 +325,73 @@ class Cluster:
 
         self.dns_server.update_hosts(hosts)
 
-    def reset(self) -> None:
-        n: Namespace
-        for n in reversed(self.namespaces.values()):
-            if n.exists():
-                n.delete()
+    def reset(self, timeout: int = 300) -> None:
+        """
+        Delete all namespaces of the cluster.
+
+        :param timeout: Seconds to wait for the namespaces to be gone.
+        """
+        # the registry goes away with its namespace
+        self.image_builder.clear_index()
 
-    def install_deps(self) -> None:
+        existing = set(Kube.Namespace.list())
+        names = [n for n in reversed(self.namespaces) if n in existing]
+        if not names:
+            return
+
+        logger.info(f"Deleting namespaces {', '.join(names)}")
+        try:
+            Kube.Namespace.delete(names, timeout=timeout)
+        except WaitTimeout as exc:
+            raise self.ClusterException(str(exc))
+
+    def install_deps(self, workers: int = 4) -> None:
+        """
+        :param workers: Maximum number of dependencies installed at the same time.
+        """
         logger.opt(colors=True).info("<blue>Installing dependencies </blue>⏳")
 
-        for d in self.deps:
-            d.install()
+        def install(dep: deps.Dependency) -> None:
+            with prefixed_output(f"[{dep.name}] "):
+                with profiler.span(f"install {dep.name}"):
+                    dep.install()
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(install, d): d for d in self.deps}
+            for i, f in enumerate(as_completed(futures), start=1):
+                exc = f.exception()
+                if exc:
+                    for pending in futures:
+                        pending.cancel()
+                    raise exc
+
+                logger.info(f"({i}/{len(self.deps)}) {futures[f].name} ready")
 
     def bootstrap(self) -> None:
+        # images built for the previous cluster are gone with its registry
+        self.image_builder.clear_index()
+
         # TODO: Disable this on prod
-        self.install_deps()
-        self.device.bootstrap()
-        self.prepare_all()
+        with profiler.span("install deps"):
+            self.install_deps()
+        with profiler.span(f"bootstrap {self.env.device.type}"):
+            self.device.bootstrap()
+        with profiler.span("prepare"):
+            self.prepare_all()
 
         logger.info("Waiting for nodes ⏳")
-        self._wait_until_ready()
+        with profiler.span("wait for nodes"):
+            self._wait_until_ready()
 
         logger.info("Cluster is ready 🍰")
 
-    def _wait_until_ready(self):
-        for i in range(60):
-            if not Kube.Node.is_all_ready():
-                time.sleep(1)
-            else:
-                return
-        raise self.ClusterException(
-            "Experienced a timeout waiting for the nodes to be ready."
-        )
+    def _wait_until_ready(self) -> None:
+        try:
+            Kube.Node.wait_until_ready(timeout=60)
+        except WaitTimeout:
+            raise self.ClusterException(
+                "Experienced a timeout waiting for the nodes to be ready."
+            )
 
     def get_apps(self) -> Dict[str, App]:
         ret = {}
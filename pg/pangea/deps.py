@@ -1,16 +1,20 @@
 import json
+import os
 import shutil
-import time
+import tempfile
 from dataclasses import dataclass
+from functools import cached_property
 from pathlib import Path
-from typing import Dict
+from typing import TYPE_CHECKING, Any, BinaryIO, Dict, Iterator, List
 
 from loguru import logger
 
-import docker
-import docker.types
-from pangea import pkg_vars
-from pangea.devops import run
+from pangea import cache, pkg_vars
+from pangea.devops import WaitTimeout, run, wait_until
+
+if TYPE_CHECKING:
+    from docker import DockerClient
+    from docker.models.images import Image
 
 __all__ = ["Dependency", "Kubectl", "Hostess", "Skaffold", "Helm", "Kind"]
 
@@ -49,6 +53,38 @@ class BinaryDep(Dependency):
         self.se = se
         self.bin_file = self.se.deps_dir / self.name
 
+    def install(self) -> None:
+        super().install()
+
+        if self.exists():
+            return
+
+        download_cache = cache.get_default()
+        cache_key = f"{self.name}-{self.se.version}"
+
+        # Download to a private directory next to the destination and rename from there
+        # so concurrent installs don't collide and the binary shows up only when complete.
+        tmp_dir = Path(tempfile.mkdtemp(prefix=f".{self.name}-", dir=self.se.deps_dir))
+        try:
+            downloaded = tmp_dir / self.name
+            if download_cache.get(cache_key, downloaded):
+                logger.info(f"Using cached {self.name}")
+            else:
+                downloaded = self._download(tmp_dir)
+                downloaded.chmod(0o755)
+                download_cache.put(cache_key, downloaded)
+
+            os.replace(str(downloaded), str(self.bin_file))
+        finally:
+            shutil.rmtree(str(tmp_dir), ignore_errors=True)
+
+    def _download(self, tmp_dir: Path) -> Path:
+        """
+        :param tmp_dir: directory to download to
+        :return: path to the downloaded binary
+        """
+        raise NotImplementedError
+
     def exists(self) -> bool:
         return self.bin_file.exists()
 
@@ -59,32 +95,44 @@ class BinaryDep(Dependency):
 class DockerDep(Dependency):
     @dataclass
     class Sets(Dependency.Sets):
-        pass
+        # compress cached tarball with zstd (requires zstandard package)
+        compress: bool = False
+
+    se: Sets
 
     image_name: str
 
+    chunk_size = 1024 * 1024
+
     def __init__(self, se: Sets) -> None:
         super().__init__(se)
         self.se = se
-        self.docker = docker.from_env()
 
         self.image_full_name = f"{self.image_name}:{self.se.version}"
 
         # tarball for caching
-        self.tar_file = Path(self.se.deps_dir) / "dns_server.tar"
+        self.tar_file = Path(self.se.deps_dir) / f"{self.name}.tar"
+        self.zst_file = Path(self.se.deps_dir) / f"{self.name}.tar.zst"
+
+    @cached_property
+    def docker(self) -> "DockerClient":
+        # connect only when docker is actually used
+        from docker import from_env
+
+        return from_env()
 
     def image_exists(self) -> bool:
         return self.docker.images.list(name=self.image_full_name) != []
 
     def exists(self) -> bool:
-        return self.tar_file.exists()
+        return self.tar_file.exists() or self.zst_file.exists()
 
     def install(self) -> None:
         super().install()
 
         if self.exists():
             if not self.image_exists():
-                self.docker.images.load(self.tar_file.read_bytes())
+                self._load()
             return
         else:
             if not self.image_exists():
@@ -94,13 +142,7 @@ class DockerDep(Dependency):
             else:
                 image = self.docker.images.list(name=self.image_full_name)[0]
 
-            self.tar_file.touch(exist_ok=True)
-
-            tar_chunks = []
-            for c in image.save():
-                tar_chunks.append(c)
-
-            self.tar_file.write_bytes(b"".join(tar_chunks))
+            self._save(image)
 
     def uninstall(self) -> None:
         if not self.exists():
@@ -108,6 +150,48 @@ class DockerDep(Dependency):
 
         self.docker.images.remove(image=self.image_full_name)
         self.tar_file.unlink(missing_ok=True)
+        self.zst_file.unlink(missing_ok=True)
+
+    def _save(self, image: "Image") -> None:
+        """
+        Stream image tarball to disk chunk by chunk.
+        """
+        out_file = self.zst_file if self.se.compress else self.tar_file
+        part_file = out_file.with_name(out_file.name + ".part")
+
+        # named so the loaded image gets its tag back
+        chunks = image.save(chunk_size=self.chunk_size, named=self.image_full_name)
+
+        with part_file.open("wb") as f:
+            if self.se.compress:
+                import zstandard
+
+                with zstandard.ZstdCompressor().stream_writer(f) as writer:
+                    for c in chunks:
+                        writer.write(c)
+            else:
+                for c in chunks:
+                    f.write(c)
+
+        os.replace(str(part_file), str(out_file))
+
+    def _load(self) -> None:
+        """
+        Stream cached tarball to docker chunk by chunk.
+        """
+        if self.zst_file.exists():
+            import zstandard
+
+            with self.zst_file.open("rb") as f:
+                reader = zstandard.ZstdDecompressor().stream_reader(f)
+                self.docker.images.load(self._iter_chunks(reader))
+        else:
+            with self.tar_file.open("rb") as f:
+                self.docker.images.load(self._iter_chunks(f))
+
+    def _iter_chunks(self, f: BinaryIO) -> Iterator[bytes]:
+        for chunk in iter(lambda: f.read(self.chunk_size), b""):
+            yield chunk
 
 
 class Kubectl(BinaryDep):
@@ -121,21 +205,14 @@ class Kubectl(BinaryDep):
         super().__init__(se)
         self.se = se
 
-    def install(self) -> None:
-        super().install()
-
-        if self.exists():
-            return
-
+    def _download(self, tmp_dir: Path) -> Path:
         run(
             f"""
-            cd /tmp
-            curl -Lso kubectl \\
+            curl -Lso {str(tmp_dir)}/kubectl \\
             "https://storage.googleapis.com/kubernetes-release/release/v{self.se.version}/bin/linux/amd64/kubectl"
-            chmod +x kubectl
-            mv kubectl {str(self.bin_file)}
             """
         )
+        return tmp_dir / "kubectl"
 
 
 class Hostess(BinaryDep):
@@ -149,20 +226,14 @@ class Hostess(BinaryDep):
         super().__init__(se)
         self.se = se
 
-    def install(self) -> None:
-        super().install()
-
-        if self.exists():
-            return
-
+    def _download(self, tmp_dir: Path) -> Path:
         run(
             f"""
-            cd /tmp
-            curl -Lso hostess https://github.com/cbednarski/hostess/releases/download/v{self.se.version}/hostess_linux_386
-            chmod u+x hostess
-            mv hostess {self.se.deps_dir}/{self.name}
+            curl -Lso {str(tmp_dir)}/hostess \\
+            https://github.com/cbednarski/hostess/releases/download/v{self.se.version}/hostess_linux_386
             """
         )
+        return tmp_dir / "hostess"
 
 
 class Helm(BinaryDep):
@@ -176,21 +247,15 @@ class Helm(BinaryDep):
         super().__init__(se)
         self.se = se
 
-    def install(self) -> None:
-        super().install()
-
-        if self.exists():
-            return
-
+    def _download(self, tmp_dir: Path) -> Path:
         release_name = f"helm-v{self.se.version}-linux-386"
         run(
             f"""
-            cd /tmp
-            curl -Lso helm.tar.gz https://get.helm.sh/{release_name}.tar.gz
-            tar -zxf helm.tar.gz
-            mv linux-386/helm {str(self.bin_file)}
+            curl -Lso {str(tmp_dir)}/helm.tar.gz https://get.helm.sh/{release_name}.tar.gz
+            tar -zxf {str(tmp_dir)}/helm.tar.gz -C {str(tmp_dir)}
             """
         )
+        return tmp_dir / "linux-386/helm"
 
 
 class Skaffold(BinaryDep):
@@ -204,21 +269,14 @@ class Skaffold(BinaryDep):
         super().__init__(se)
         self.se = se
 
-    def install(self) -> None:
-        super().install()
-
-        if self.exists():
-            return
-
+    def _download(self, tmp_dir: Path) -> Path:
         run(
             f"""
-            cd /tmp
-            curl -Lso skaffold \\
+            curl -Lso {str(tmp_dir)}/skaffold \\
                 "https://storage.googleapis.com/skaffold/releases/v{self.se.version}/skaffold-linux-amd64"
-            chmod +x skaffold
-            mv skaffold {str(self.bin_file)}
             """
         )
+        return tmp_dir / "skaffold"
 
 
 class Kind(BinaryDep):
@@ -232,21 +290,14 @@ class Kind(BinaryDep):
         super().__init__(se)
         self.se = se
 
-    def install(self) -> None:
-        super().install()
-
-        if self.exists():
-            return
-
+    def _download(self, tmp_dir: Path) -> Path:
         run(
             f"""
-            cd /tmp
-            curl -Lso kind \\
+            curl -Lso {str(tmp_dir)}/kind \\
                 "https://github.com/kubernetes-sigs/kind/releases/download/v{self.se.version}/kind-$(uname)-amd64"
-            chmod +x kind
-            mv kind {str(self.bin_file)}
             """
         )
+        return tmp_dir / "kind"
 
 
 class DnsServer(DockerDep):
@@ -257,6 +308,7 @@ class DnsServer(DockerDep):
     name = "dns_server"
     container_name = "pangea_dns_server"
     image_name = "defreitas/dns-proxy-server"
+    api_port = 5380
 
     def __init__(self, se: Sets) -> None:
         super().__init__(se)
@@ -283,9 +335,11 @@ class DnsServer(DockerDep):
         )
 
     def start(self) -> None:
+        import docker.errors
+
         self._wait_until_not_running()
 
-        self.docker.containers.run(
+        container = self.docker.containers.run(
             image=self.image_full_name,
             hostname="dns.pangea",
             detach=True,
@@ -298,9 +352,19 @@ class DnsServer(DockerDep):
             auto_remove=True,
         )
 
-        time.sleep(2)
-        if not self.is_running():
-            raise RuntimeError("Dns server has crashed.!")
+        def started() -> bool:
+            try:
+                container.reload()
+            except docker.errors.NotFound:
+                # auto removed after exiting
+                raise RuntimeError("Dns server has crashed.!")
+
+            if container.status in ("exited", "dead"):
+                raise RuntimeError("Dns server has crashed.!")
+
+            return bool(container.status == "running")
+
+        wait_until(started, timeout=10, description="dns_server to start")
 
     def stop(self) -> None:
         self.docker.containers.get(self.container_name).stop()
@@ -328,27 +392,82 @@ class DnsServer(DockerDep):
 
     def update_hosts(self, hosts: Dict[str, str]) -> None:
         """
-        :param hosts:
+        Changes are applied to the running server through its api.
+        It's restarted only if that fails.
+
+        :param hosts: Dict[hostname, ip]
         """
+        old_hosts = self.get_hosts()
+        if hosts == old_hosts:
+            logger.debug("Dns hosts are up to date")
+            return
+
         content = json.loads(self.conf_file.read_text())
+        env = content["envs"][0]
 
-        payload = []
-        for i, (k, v) in enumerate(hosts.items()):
-            payload.append(
-                {"id": i + 1, "ttl": 100000000, "hostname": k, "ip": v,}
-            )
+        # keep ids of existing entries stable
+        old_entries = {h["hostname"]: h for h in env["hostnames"]}
+        next_id = max((h["id"] for h in old_entries.values()), default=0) + 1
+
+        entries = []
+        for hostname, ip in hosts.items():
+            entry = old_entries.get(hostname)
+            if not entry:
+                entry = {"id": next_id, "ttl": 100000000, "hostname": hostname}
+                next_id += 1
+            entries.append({**entry, "ip": ip})
+
+        env["hostnames"] = entries
 
-        content["envs"][0]["hostnames"] = payload
+        running = self.is_running()
+        applied = running and self._apply_in_place(env["name"], old_hosts, entries)
 
         self.conf_file.write_text(json.dumps(content, indent=4, sort_keys=True))
 
-        if self.is_running():
+        if running and not applied:
             self.restart()
 
-    def _wait_until_not_running(self):
-        for i in range(5):
-            time.sleep(0.5)
-            if not self.is_running():
-                return
-        else:
-            raise RuntimeError("Timeout waiting for dns_server to stop!")
+    def _apply_in_place(
+        self, env_name: str, old_hosts: Dict[str, str], entries: List[Dict[str, Any]]
+    ) -> bool:
+        """
+        :return: False if the running server couldn't be updated
+        """
+        import docker.errors
+        import requests
+
+        try:
+            container = self.docker.containers.get(self.container_name)
+            ip = container.attrs["NetworkSettings"]["IPAddress"]
+            url = f"http://{ip}:{self.api_port}/hostname/"
+
+            with requests.Session() as session:
+                for e in entries:
+                    payload = {**e, "env": env_name, "type": "A"}
+                    if e["hostname"] not in old_hosts:
+                        session.post(url, json=payload, timeout=5).raise_for_status()
+                    elif old_hosts[e["hostname"]] != e["ip"]:
+                        session.put(url, json=payload, timeout=5).raise_for_status()
+
+                removed = old_hosts.keys() - {e["hostname"] for e in entries}
+                for hostname in removed:
+                    payload = {"env": env_name, "hostname": hostname}
+                    session.delete(url, json=payload, timeout=5).raise_for_status()
+        except (docker.errors.NotFound, requests.exceptions.RequestException) as exc:
+            logger.debug(f"Couldn't update dns hosts in place ({exc}), restarting")
+            return False
+
+        return True
+
+    def _wait_until_not_running(self, timeout: float = 10) -> None:
+        import docker.errors
+        import requests
+
+        try:
+            container = self.docker.containers.get(self.container_name)
+            # the container is auto removed so removal is the last thing that happens to it
+            container.wait(timeout=timeout, condition="removed")
+        except docker.errors.NotFound:
+            return
+        except requests.exceptions.RequestException:
+            raise WaitTimeout("Timeout waiting for dns_server to stop!")
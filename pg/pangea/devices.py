@@ -1,14 +1,12 @@
-import re
-import time
 from pathlib import Path
 
-from jinja2 import Template
 from loguru import logger
 
 import environ
 from pangea import pkg_vars
 from pangea.devops import run
 from pangea.env import ClusterEnv
+from pangea.kube import Kube
 
 environ = environ.Env()
 
@@ -41,6 +39,8 @@ class Kind(ClusterDevice):
 
         logger.info("Creating kind cluster ⏳")
 
+        from jinja2 import Template
+
         template = Template((pkg_vars.templates_dir / "kind.yaml.templ").read_text())
         kind_file = Path(f"kind.{self.env.stage}.yaml")
         context = {"env": self.env}
@@ -70,10 +70,12 @@ class Kind(ClusterDevice):
         self._post_bootstrap()
 
     def get_ip(self) -> str:
-        result = run(f"""kubectl describe nodes {self.env.device.name}""")
-        ip_phrase = re.search(r"InternalIP: .*", "\n".join(result)).group(0)
-        ip = ip_phrase.split(":")[1].strip()
-        return ip.strip()
+        node = next(
+            n for n in Kube.Node.list() if n.name.startswith(self.env.device.name)
+        )
+        ip = node.get_address("InternalIP")
+        assert ip
+        return ip
 
 
 class Microk8s(ClusterDevice):
@@ -110,7 +112,7 @@ class Microk8s(ClusterDevice):
             progress_bar=True,
         )
 
-        time.sleep(30)
+        run("sudo microk8s.status --wait-ready --timeout 300")
 
         self._post_bootstrap()
 
@@ -139,10 +141,9 @@ class Aws(ClusterDevice):
         self._post_bootstrap()
 
     def get_ip(self) -> str:
-        result = run(f"""kubectl describe nodes""")
-        ip_phrase = re.search(r"ExternalIP: .*", "\n".join(result)).group(0)
-        ip = ip_phrase.split(":")[1].strip()
-        return ip.strip()
+        ip = next(n.get_address("ExternalIP") for n in Kube.Node.list())
+        assert ip
+        return ip
 
 
 all = {"kind": Kind, "aws": Aws, "microk8s": Microk8s}
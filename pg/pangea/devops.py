@@ -1,14 +1,34 @@
+import atexit
+import codecs
 import os
 import re
+import selectors
+import subprocess
 import sys
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
 from getpass import getpass
-from typing import List
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    FrozenSet,
+    Iterator,
+    List,
+    Optional,
+    Pattern,
+    Tuple,
+    Type,
+)
 
 from loguru import logger
 
 import environ
-import pexpect
-from tqdm import tqdm
+from pangea import profiler
 
 environ = environ.Env()
 
@@ -17,58 +37,263 @@ class CommandError(RuntimeError):
     pass
 
 
-class CustomPrint:
-    def __init__(self, prompt: str, command: str) -> None:
-        self.old_stdout = sys.stdout
-        self.command = command
-        self.prompt = prompt
+class CommandTimeout(CommandError):
+    pass
+
+
+class WaitTimeout(RuntimeError):
+    pass
+
+
+# prepended to printed command output and log messages of the current thread
+output_prefix: ContextVar[str] = ContextVar("output_prefix", default="")
+
+
+@contextmanager
+def prefixed_output(prefix: str) -> Iterator[None]:
+    token = output_prefix.set(prefix)
+    try:
+        yield
+    finally:
+        output_prefix.reset(token)
+
+
+def prefix_log_record(record: Dict[str, Any]) -> None:
+    """
+    Loguru patcher adding output prefix to log messages.
+    """
+    prefix = output_prefix.get()
+    if prefix:
+        record["message"] = prefix + record["message"]
+
+
+class _Terminal:
+    """
+    Raw command output written to stdout as it arrives, with output prefix at line starts.
+    """
+
+    def __init__(self) -> None:
+        self.prefix = output_prefix.get()
+        self.line_start = True
+
+    def write(self, text: str) -> None:
+        out = []
+        for piece in text.splitlines(keepends=True):
+            if self.line_start:
+                out.append(self.prefix)
+            out.append(piece)
+            # carriage return moves back to the line start, redrawing progress bars
+            self.line_start = piece.endswith(("\n", "\r"))
+
+        sys.stdout.write("".join(out))
+        sys.stdout.flush()
+
+    def end_line(self) -> None:
+        if not self.line_start:
+            self.write("\n")
+
+
+class Shell:
+    """
+    Long living bash session.
 
-    def write(self, text: bytes) -> None:
-        text_str: str = text.decode("utf-8")
+    Spawning bash and synchronising the prompt is the most expensive part of running a
+    short command, so sessions are reused through ShellPool.
+    """
 
-        for line in text_str.splitlines(keepends=True):
-            if len(text_str) == 0:
+    state_script = (
+        "set +o; shopt -p; declare -p; declare -f; trap -p; alias -p; umask; ulimit -a"
+    )
+    # variables that change by themselves or with cd, which is restored anyway
+    volatile_var = re.compile(
+        r"declare -\S+ (_|BASH_COMMAND|BASH_LINENO|BASH_REMATCH|BASHPID|COLUMNS|"
+        r"EPOCHREALTIME|EPOCHSECONDS|HISTCMD|LINENO|LINES|OLDPWD|PIPESTATUS|PWD|"
+        r"RANDOM|SECONDS|SRANDOM|__pg_rc)="
+    )
+
+    # seconds a command can go without printing anything
+    timeout: float = 60 * 15
+
+    # printed after every command, end_re captures the exit code
+    end_marker: str
+    end_re: Pattern
+    # what can follow end_marker in an end cut off at a chunk boundary
+    end_partial_re: Pattern
+
+    def __init__(self, cwd: str, env: Dict[str, str]) -> None:
+        self.cwd = cwd
+        self.env = env
+        self.sudo_granted = False
+        self.ret_code = 0
+        # set by ShellPool when the shell is spawned
+        self.initial_state: List[str] = []
+
+    def iter_lines(
+        self, command: str, on_output: Optional[Callable[[str], None]] = None
+    ) -> Iterator[str]:
+        """
+        Yield output lines of a command as they arrive. Exit code is stored in ret_code.
+
+        :param on_output: called with raw output as it arrives, before it's split into
+        lines, so progress bars and prompts without a line break show up right away
+        """
+        raise NotImplementedError
+
+    def _split_output(
+        self, chunks: Iterator[str], on_output: Optional[Callable[[str], None]]
+    ) -> Iterator[str]:
+        """
+        Split raw output into lines until the end marker carrying the exit code shows up.
+        """
+        # received but not handed out yet because it might be the start of the marker
+        pending = ""
+        # incomplete last line
+        tail = ""
+
+        for chunk in chunks:
+            pending += chunk
+            match = self.end_re.search(pending)
+            cut = match.start() if match else self._partial_end_start(pending)
+            output, pending = pending[:cut], pending[cut:]
+
+            if output and on_output:
+                on_output(output)
+
+            lines = (tail + output).split("\n")
+            tail = lines.pop()
+            for line in lines:
+                yield line.rstrip()
+
+            if match:
+                # last line of the output might be missing a line break
+                if tail.rstrip():
+                    yield tail.rstrip()
+                self.ret_code = int(match.group(1))
                 return
 
-            if not any((s in line) for s in [self.command, self.prompt]):
-                self.old_stdout.write(line)
+    def _partial_end_start(self, text: str) -> int:
+        """
+        :return: index where an end cut off at the end of text starts, len(text) if none
+        """
+        start = text.rfind(self.end_marker)
+        if start != -1 and self.end_partial_re.fullmatch(
+            text, start + len(self.end_marker)
+        ):
+            return start
 
-    def flush(self) -> None:
-        self.old_stdout.flush()
+        # only part of the marker itself arrived
+        for size in range(min(len(self.end_marker) - 1, len(text)), 0, -1):
+            if text.endswith(self.end_marker[:size]):
+                return len(text) - size
 
+        return len(text)
 
-def run(
-    command: str,
-    ignore_errors: bool = False,
-    print_output: bool = False,
-    progress_bar: bool = False,
-) -> List[str]:
-    # preprocess
-    # join multilines
-    command = re.sub(r"\\(?:\t| )*\n(?:\t| )*", "", command)
+    def execute(self, command: str) -> Tuple[List[str], int]:
+        """
+        :return: output lines and exit code
+        """
+        outputs = list(self.iter_lines(command))
+        return outputs, self.ret_code
 
-    commands: List[str] = [s.strip() for s in command.splitlines() if s.strip()]
+    def get_state(self) -> List[str]:
+        """
+        Options, variables, functions, traps etc. of the session.
 
-    rets: List[str] = []
+        Compared before a shell goes back to the pool, so commands that leave a trace
+        (assignments, set -e, function definitions...) don't leak into later runs.
+        """
+        lines, _ = self.execute(self.state_script)
+        return [line for line in lines if not self.volatile_var.match(line)]
+
+    def is_alive(self) -> bool:
+        raise NotImplementedError
+
+    def is_healthy(self) -> bool:
+        """
+        Check if the session responds and bring it back to its working directory.
+        """
+        if not self.is_alive():
+            return False
+
+        try:
+            return self.execute(f"cd '{self.cwd}'")[1] == 0
+        except CommandError:
+            return False
+
+    def close(self) -> None:
+        raise NotImplementedError
+
+
+class PtyShell(Shell):
+    """
+    Bash running in a pseudo terminal. Needed for sudo and live output.
+    """
+
+    prompt = "##PG_PROMPT##"
+    # PS1 is expanded after every command so the prompt carries the exit code with it
+    prompt_re = prompt + r"(\d+)##"
+
+    end_marker = prompt
+    end_re = re.compile(prompt_re)
+    end_partial_re = re.compile(r"(\d+#?)?")
 
-    prompt = r"##PG_PROMPT##"
+    def __init__(self, cwd: str, env: Dict[str, str]) -> None:
+        import pexpect
+
+        super().__init__(cwd, env)
+
+        self.p = pexpect.spawn(
+            "bash --rcfile /dev/null --noediting",
+            env=self.env,
+            cwd=self.cwd,
+            echo=False,
+        )
+        self.p.delaybeforesend = None
+
+        self.p.expect(r"(\$|#)")
+        # output is passed through as is, so keep line breaks the way commands print them
+        self.p.sendline(f"stty -onlcr; export PS1='{self.prompt}$?##'")
+        self.p.expect(self.prompt_re)
+
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    def iter_lines(
+        self, command: str, on_output: Optional[Callable[[str], None]] = None
+    ) -> Iterator[str]:
+        self.p.sendline(command)
+        yield from self._split_output(self._read_chunks(), on_output)
+
+    def _read_chunks(self) -> Iterator[str]:
+        """
+        :raises CommandTimeout: when nothing was printed for self.timeout seconds
+        """
+        import pexpect
+
+        # left over from the last expect call
+        if self.p.buffer:
+            yield self._decoder.decode(self.p.buffer)
+            self.p.buffer = b""
+
+        while True:
+            try:
+                chunk = self.p.read_nonblocking(64 * 1024, timeout=self.timeout)
+            except pexpect.exceptions.EOF:
+                raise CommandError("Shell exited unexpectedly")
+            except pexpect.exceptions.TIMEOUT:
+                raise CommandTimeout(f"No output for {self.timeout}s")
 
-    p = pexpect.spawn("bash --rcfile /dev/null", env=os.environ, echo=False)
-    p.delaybeforesend = None
+            yield self._decoder.decode(chunk)
 
-    p.expect(r"(\$|#)")
-    p.sendline(f"export PS1={prompt}")
-    p.expect(prompt)
+    def grant_sudo(self) -> None:
+        import pexpect
 
-    # Get sudo password if needed
-    if "sudo " in command:
         tries = 3
         while True:
             sudo_password = getpass("Sudo password: ")
-            p.sendline('sudo echo "granting sudo"')
-            p.sendline(sudo_password)
+            self.p.sendline('sudo echo "granting sudo"')
+            self.p.sendline(sudo_password)
             try:
-                p.expect(prompt, timeout=1)
+                self.p.expect(self.prompt_re, timeout=1)
                 print("Thank you.")
             except pexpect.exceptions.TIMEOUT:
                 tries -= 1
@@ -81,41 +306,321 @@ def run(
                 continue
             break
 
-    pbar: tqdm
-    if progress_bar:
-        pbar = tqdm(total=len(commands))
-
-    for c in commands:
-        if "PG_DEBUG" in environ:
-            logger.debug(c)
-
-        if print_output:
-            p.logfile = CustomPrint(command=c, prompt=prompt)
-        p.sendline(c)
-        p.expect(prompt, timeout=60 * 15)
-        if print_output:
-            p.logfile = None
-
-        raw_outputs: List[bytes] = p.before.splitlines()
-        outputs: List[str] = [s.decode("utf-8").strip() for s in raw_outputs]
-        # get exit code
-        p.sendline('echo "$?"')
-        p.expect(prompt)
-        ret_code = int(p.before.splitlines()[0].strip())
-
-        ret = ""
-        if outputs:
-            ret = "\n".join(outputs)
-            rets.append(ret)
-
-        if not ignore_errors:
-            if ret_code != 0:
-                raise CommandError(ret)
+        self.sudo_granted = True
+
+    def is_sudo_valid(self) -> bool:
+        """
+        Check if sudo was granted and its cached credentials haven't expired yet.
+        """
+        return self.sudo_granted and self.execute("sudo -n true")[1] == 0
+
+    def is_alive(self) -> bool:
+        return bool(self.p.isalive())
+
+    def close(self) -> None:
+        self.p.close(force=True)
+
+
+class PipeShell(Shell):
+    """
+    Bash fed through plain pipes.
+
+    Exit code comes in a sentinel line printed after each command, which is simpler to
+    match than a prompt.
+    """
+
+    sentinel = "##PG_EXIT_CODE##"
 
+    end_marker = sentinel
+    end_re = re.compile(sentinel + r"(\d+)\n")
+    end_partial_re = re.compile(r"\d*")
+
+    def __init__(self, cwd: str, env: Dict[str, str]) -> None:
+        super().__init__(cwd, env)
+
+        self.p = subprocess.Popen(
+            ["bash", "--noprofile", "--norc"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            cwd=self.cwd,
+            env=self.env,
+        )
+        assert self.p.stdout
+
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self.p.stdout, selectors.EVENT_READ)
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+        # lets the sentinel line hand the exit code back to the next command as $?
+        self._write("__pg_return() { return $1; }\n")
+
+    def iter_lines(
+        self, command: str, on_output: Optional[Callable[[str], None]] = None
+    ) -> Iterator[str]:
+        # commands get /dev/null as stdin so they can't swallow the rest of the script
+        self._write(
+            f"{{ {command}\n}} </dev/null\n"
+            f"__pg_rc=$?; printf '{self.sentinel}%s\\n' $__pg_rc; __pg_return $__pg_rc\n"
+        )
+
+        yield from self._split_output(self._read_chunks(), on_output)
+
+    def _read_chunks(self) -> Iterator[str]:
+        """
+        :raises CommandTimeout: when nothing was printed for self.timeout seconds
+        """
+        assert self.p.stdout
+        fd = self.p.stdout.fileno()
+
+        while True:
+            if not self._selector.select(self.timeout):
+                raise CommandTimeout(f"No output for {self.timeout}s")
+
+            chunk = os.read(fd, 64 * 1024)
+            if not chunk:
+                raise CommandError("Shell exited unexpectedly")
+
+            yield self._decoder.decode(chunk)
+
+    def _write(self, script: str) -> None:
+        assert self.p.stdin
+
+        try:
+            self.p.stdin.write(script.encode("utf-8"))
+            self.p.stdin.flush()
+        except BrokenPipeError:
+            raise CommandError("Shell exited unexpectedly")
+
+    def is_alive(self) -> bool:
+        return self.p.poll() is None
+
+    def close(self) -> None:
+        if self.is_alive():
+            self.p.kill()
+        self.p.wait()
+        self._selector.close()
+
+        for f in (self.p.stdin, self.p.stdout):
+            if f:
+                f.close()
+
+
+class ShellPool:
+    """
+    Pool of idle shells keyed by shell type, working directory and environment.
+
+    Shells whose state changed since they were spawned are not reused.
+    """
+
+    def __init__(self) -> None:
+        self._idle: Dict[Tuple[Type[Shell], str, FrozenSet], List[Shell]] = defaultdict(
+            list
+        )
+        self._lock = threading.Lock()
+
+    def acquire(self, shell_type: Type[Shell]) -> Shell:
+        key = (shell_type, os.getcwd(), frozenset(os.environ.items()))
+
+        while True:
+            with self._lock:
+                if not self._idle[key]:
+                    break
+                shell = self._idle[key].pop()
+
+            if shell.is_healthy():
+                return shell
+
+            logger.debug("Respawning unhealthy shell")
+            shell.close()
+
+        shell = shell_type(cwd=key[1], env=dict(key[2]))
+        shell.initial_state = shell.get_state()
+        return shell
+
+    def release(self, shell: Shell) -> None:
+        try:
+            reusable = shell.is_alive() and shell.get_state() == shell.initial_state
+        except CommandError:
+            reusable = False
+
+        if not reusable:
+            shell.close()
+            return
+
+        with self._lock:
+            self._idle[(type(shell), shell.cwd, frozenset(shell.env.items()))].append(
+                shell
+            )
+
+    def discard(self, shell: Shell) -> None:
+        shell.close()
+
+    def close(self) -> None:
+        with self._lock:
+            for shells in self._idle.values():
+                for s in shells:
+                    s.close()
+            self._idle.clear()
+
+
+shell_pool = ShellPool()
+atexit.register(shell_pool.close)
+
+
+# passwords and tokens in command lines, masked before commands are recorded in timings
+_secret = re.compile(
+    r"((?:^|\s)-p|--(?:password|token)[= ]|\b\w*(?:PASSWORD|TOKEN|SECRET)=)\S+",
+    re.IGNORECASE,
+)
+
+
+def redact(command: str) -> str:
+    return _secret.sub(r"\1***", command)
+
+
+def _split_commands(command: str) -> List[str]:
+    # join multilines
+    command = re.sub(r"\\(?:\t| )*\n(?:\t| )*", "", command)
+    return [s.strip() for s in command.splitlines() if s.strip()]
+
+
+@contextmanager
+def _session(commands: List[str], print_output: bool) -> Iterator[Shell]:
+    needs_sudo = any("sudo " in c for c in commands)
+    shell = shell_pool.acquire(PtyShell if print_output or needs_sudo else PipeShell)
+
+    try:
+        # Get sudo password if needed
+        if needs_sudo:
+            assert isinstance(shell, PtyShell)
+            if not shell.is_sudo_valid():
+                shell.grant_sudo()
+
+        yield shell
+    except CommandTimeout:
+        # command is still running
+        shell_pool.discard(shell)
+        raise
+    except CommandError:
+        shell_pool.release(shell)
+        raise
+    except BaseException:
+        # interrupts, abandoned iterators etc.
+        # leave the session in an unknown state
+        shell_pool.discard(shell)
+        raise
+
+    shell_pool.release(shell)
+
+
+def run(
+    command: str,
+    ignore_errors: bool = False,
+    print_output: bool = False,
+    progress_bar: bool = False,
+) -> List[str]:
+    commands = _split_commands(command)
+
+    rets: List[str] = []
+
+    with _session(commands, print_output) as shell:
+        pbar = None
         if progress_bar:
-            pbar.update(1)
+            from tqdm import tqdm
+
+            pbar = tqdm(total=len(commands))
+
+        for c in commands:
+            if "PG_DEBUG" in environ:
+                logger.debug(c)
+
+            outputs: List[str] = []
+            terminal = _Terminal() if print_output else None
+            recorded = redact(c)
+            with profiler.span(f"run {recorded[:80]}", command=recorded):
+                for line in shell.iter_lines(c, terminal.write if terminal else None):
+                    outputs.append(line.strip())
+
+            if terminal:
+                terminal.end_line()
+
+            ret = ""
+            if outputs:
+                ret = "\n".join(outputs)
+                rets.append(ret)
+
+            if not ignore_errors:
+                if shell.ret_code != 0:
+                    raise CommandError(ret)
 
-    if progress_bar:
-        pbar.close()
+            if pbar:
+                pbar.update(1)
+
+        if pbar:
+            pbar.close()
 
     return rets
+
+
+def run_iter(
+    command: str,
+    ignore_errors: bool = False,
+    print_output: bool = False,
+    error_lines: int = 100,
+) -> Iterator[str]:
+    """
+    Like run but yields output lines as they arrive instead of collecting them.
+
+    Only the last error_lines lines of a command are kept to build CommandError message.
+    Closing the iterator before it's exhausted kills the running command.
+    """
+    commands = _split_commands(command)
+
+    with _session(commands, print_output) as shell:
+        for c in commands:
+            if "PG_DEBUG" in environ:
+                logger.debug(c)
+
+            tail: Deque[str] = deque(maxlen=error_lines)
+            terminal = _Terminal() if print_output else None
+            recorded = redact(c)
+            with profiler.span(f"run {recorded[:80]}", command=recorded):
+                for line in shell.iter_lines(c, terminal.write if terminal else None):
+                    tail.append(line)
+                    yield line
+
+            if terminal:
+                terminal.end_line()
+
+            if not ignore_errors:
+                if shell.ret_code != 0:
+                    raise CommandError("\n".join(tail))
+
+
+def wait_until(
+    condition: Callable[[], bool],
+    timeout: float,
+    description: str,
+    min_interval: float = 0.05,
+    max_interval: float = 2.0,
+) -> None:
+    """
+    Call condition until it returns True.
+
+    Checks start right away and back off exponentially, so things that are ready
+    quickly are not held up by a fixed poll interval.
+
+    :param timeout: Seconds after which WaitTimeout is raised.
+    :param description: What is waited for, used in the error message.
+    """
+    deadline = time.monotonic() + timeout
+    interval = min_interval
+
+    while not condition():
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise WaitTimeout(f"Timeout waiting for {description}")
+
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 2, max_interval)
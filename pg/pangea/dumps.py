@@ -0,0 +1,127 @@
+import os
+import subprocess
+import tempfile
+from pathlib import Path
+from typing import IO, List
+
+from pangea import profiler
+from pangea.devops import CommandError
+
+__all__ = ["dump", "restore"]
+
+chunk_size = 1024 * 1024
+
+
+def dump(namespace: str, pod: str, command: str, dst: Path) -> None:
+    """
+    Stream stdout of a command run in a pod straight into a local file.
+
+    Output is gzipped in the pod when dst ends with ".gz". Data goes to dst.part first
+    so an interrupted dump never replaces the last good one.
+    """
+    from tqdm import tqdm
+
+    script = _compress(command) if dst.suffix == ".gz" else command
+    part = dst.with_name(dst.name + ".part")
+    dst.parent.mkdir(parents=True, exist_ok=True)
+
+    with profiler.span(f"dump {pod}", command=command), _errors_file() as errors:
+        p = subprocess.Popen(
+            _exec_args(namespace, pod, script), stdout=subprocess.PIPE, stderr=errors
+        )
+        assert p.stdout
+        stdout = p.stdout
+
+        try:
+            with part.open("wb") as f, tqdm(
+                desc=dst.name, unit="B", unit_scale=True
+            ) as pbar:
+                for chunk in iter(lambda: stdout.read(chunk_size), b""):
+                    f.write(chunk)
+                    pbar.update(len(chunk))
+
+            _check(p, errors)
+        except BaseException:
+            p.kill()
+            part.unlink(missing_ok=True)
+            raise
+        finally:
+            stdout.close()
+            p.wait()
+
+    os.replace(str(part), str(dst))
+
+
+def restore(namespace: str, pod: str, command: str, src: Path) -> None:
+    """
+    Stream a local file to stdin of a command run in a pod.
+
+    Files ending with ".gz" are decompressed in the pod.
+    """
+    from tqdm import tqdm
+
+    script = _decompress(command) if src.suffix == ".gz" else command
+
+    with profiler.span(f"restore {pod}", command=command), _errors_file() as errors:
+        p = subprocess.Popen(
+            _exec_args(namespace, pod, script, stdin=True),
+            stdin=subprocess.PIPE,
+            stdout=errors,
+            stderr=errors,
+        )
+        assert p.stdin
+
+        try:
+            with src.open("rb") as f, tqdm(
+                desc=src.name, total=src.stat().st_size, unit="B", unit_scale=True
+            ) as pbar:
+                for chunk in iter(lambda: f.read(chunk_size), b""):
+                    p.stdin.write(chunk)
+                    pbar.update(len(chunk))
+        except BrokenPipeError:
+            # command exited early, the reason is in its output
+            pass
+        except BaseException:
+            p.kill()
+            raise
+        finally:
+            try:
+                p.stdin.close()
+            except BrokenPipeError:
+                pass
+
+        _check(p, errors)
+
+
+def _exec_args(namespace: str, pod: str, script: str, stdin: bool = False) -> List[str]:
+    return [
+        "kubectl",
+        "-n",
+        namespace,
+        "exec",
+        *(["-i"] if stdin else []),
+        pod,
+        "--",
+        "bash",
+        "-c",
+        script,
+    ]
+
+
+def _compress(command: str) -> str:
+    return f"set -o pipefail; {command} | gzip -c"
+
+
+def _decompress(command: str) -> str:
+    return f"set -o pipefail; gunzip -c | {command}"
+
+
+def _errors_file() -> IO[bytes]:
+    # a file rather than a pipe so a chatty command can't block on a full pipe buffer
+    return tempfile.TemporaryFile()
+
+
+def _check(p: "subprocess.Popen[bytes]", errors: IO[bytes]) -> None:
+    if p.wait() != 0:
+        errors.seek(0)
+        raise CommandError(errors.read().decode("utf-8", errors="replace").strip())
@@ -1,41 +1,508 @@
+import base64
+import hashlib
+import json
+import tempfile
+import threading
+import time
 import typing
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from dataclasses import dataclass
+from functools import cached_property
 from pathlib import Path
-from typing import TYPE_CHECKING, List, Optional, Tuple
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Generic,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Type,
+    TypeVar,
+    Union,
+)
 
 from loguru import logger
 
 import environ
-from pangea.devops import CommandError, run
+from pangea import dumps, profiler
+from pangea.devops import (
+    CommandError,
+    WaitTimeout,
+    prefixed_output,
+    run,
+    wait_until,
+)
 
 if TYPE_CHECKING:
+    import requests
     from pangea.apps import App
 
 environ = environ.Env()
 
+T = TypeVar("T")
+
+
+def _run_json(command: str) -> List[str]:
+    """
+    Run a command printing json.
+
+    Shells merge stderr into the output and warnings printed there would break parsing,
+    so it goes to a file and only ends up in the error message.
+    """
+    with tempfile.NamedTemporaryFile("r", prefix="pangea-stderr-") as stderr:
+        try:
+            return run(f"{command} 2>{stderr.name}")
+        except CommandError:
+            raise CommandError(stderr.read())
+
+
+class KubeObject:
+    """
+    Kubernetes object from kubectl json output. Decoded on first access.
+    """
+
+    def __init__(self, raw: Union[str, Dict[str, Any]]) -> None:
+        self._raw = raw
+
+    @cached_property
+    def data(self) -> Dict[str, Any]:
+        if isinstance(self._raw, str):
+            data: Dict[str, Any] = json.loads(self._raw)
+            return data
+
+        return self._raw
+
+    @property
+    def name(self) -> str:
+        name: str = self.data["metadata"]["name"]
+        return name
+
+    def has_condition(self, condition: str) -> bool:
+        return any(
+            c["type"] == condition and c["status"] == "True"
+            for c in self.data.get("status", {}).get("conditions", [])
+        )
+
+
+class NodeObject(KubeObject):
+    @property
+    def is_ready(self) -> bool:
+        return self.has_condition("Ready")
+
+    def get_address(self, address_type: str) -> Optional[str]:
+        """
+        :param address_type: InternalIP, ExternalIP, Hostname etc.
+        """
+        for a in self.data["status"].get("addresses", []):
+            if a["type"] == address_type:
+                address: str = a["address"]
+                return address
+
+        return None
+
+
+K = TypeVar("K", bound=KubeObject)
+
+
+class KubeList(Generic[K]):
+    """
+    Result of "kubectl get -o json". Items are decoded on first access.
+    """
+
+    def __init__(self, raw: str, item_type: Type[K]) -> None:
+        self._raw = raw
+        self.item_type = item_type
+
+    @cached_property
+    def items(self) -> List[K]:
+        return [self.item_type(i) for i in json.loads(self._raw)["items"]]
+
+    @property
+    def names(self) -> List[str]:
+        return [i.name for i in self.items]
+
+    def __iter__(self) -> Iterator[K]:
+        return iter(self.items)
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+
+class PodObject(KubeObject):
+    @property
+    def is_ready(self) -> bool:
+        return self.has_condition("Ready")
+
+
+@dataclass
+class PodResult:
+    pod: str
+    output: List[str]
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+class KubectlBackend:
+    """
+    Runs kubectl for every operation.
+    """
+
+    def get(
+        self,
+        resource: str,
+        namespace: Optional[str] = None,
+        selector: Optional[str] = None,
+    ) -> str:
+        """
+        :param selector: label selector
+        :return: raw json list of resources
+        """
+        ns = f"--namespace={namespace} " if namespace else ""
+        labels = f"--selector={selector} " if selector else ""
+        return _run_json(f"kubectl get {resource} {ns}{labels}-o json")[0]
+
+    def create_namespace(self, name: str) -> None:
+        run(f"kubectl create namespace {name}")
+
+    def wait_for_pod(self, namespace: str, pod: str, timeout: int) -> None:
+        run(
+            f"kubectl -n {namespace} wait --for=condition=ready pod {pod} --timeout={timeout}s"
+        )
+
+    def exec(
+        self,
+        namespace: str,
+        pod: str,
+        command: str,
+        print_output: bool = False,
+        timeout: Optional[int] = None,
+    ) -> List[str]:
+        """
+        :param timeout: Kill kubectl after this many seconds.
+        """
+        return run(
+            f'{self._timeout(timeout)}kubectl -n {namespace} exec {pod} -- bash -c "{command}"',
+            print_output=print_output,
+        )
+
+    def copy(
+        self,
+        namespace: str,
+        src_path: str,
+        dst_path: str,
+        timeout: Optional[int] = None,
+    ) -> None:
+        run(f"{self._timeout(timeout)}kubectl -n {namespace} cp {src_path} {dst_path}")
+
+    @staticmethod
+    def _timeout(timeout: Optional[int]) -> str:
+        return f"timeout {timeout} " if timeout else ""
+
+
+class ApiBackend(KubectlBackend):
+    """
+    Talks to the api server directly through a pooled http session.
+
+    exec and cp need a streaming protocol (SPDY/websockets) so they still go through kubectl.
+    """
+
+    @dataclass
+    class Sets:
+        kubeconfig: Path
+        pool_size: int = 10
+        timeout: float = 30
+
+    def __init__(self, se: Sets) -> None:
+        self.se = se
+
+        self._session: Optional["requests.Session"] = None
+        self._server = ""
+        self._lock = threading.Lock()
+        self._certs_dir = tempfile.TemporaryDirectory(prefix="pangea-kube-")
+
+    def get(
+        self,
+        resource: str,
+        namespace: Optional[str] = None,
+        selector: Optional[str] = None,
+    ) -> str:
+        params = {"labelSelector": selector} if selector else {}
+        return self._request("GET", self._path(resource, namespace), params=params).text
+
+    def create_namespace(self, name: str) -> None:
+        namespace = {
+            "apiVersion": "v1",
+            "kind": "Namespace",
+            "metadata": {"name": name},
+        }
+        self._request("POST", self._path("namespaces"), json=namespace)
+
+    def wait_for_pod(self, namespace: str, pod: str, timeout: int) -> None:
+        """
+        Watch the pod instead of polling it.
+        """
+        params = {
+            "fieldSelector": f"metadata.name={pod}",
+            "watch": "true",
+            "timeoutSeconds": timeout,
+        }
+        response = self._request(
+            "GET",
+            self._path("pods", namespace),
+            params=params,
+            stream=True,
+            timeout=timeout + self.se.timeout,
+        )
+
+        with response:
+            # existing pod comes as ADDED event first
+            for line in response.iter_lines():
+                event = json.loads(line)
+                if event["type"] in ("ADDED", "MODIFIED"):
+                    if PodObject(event["object"]).is_ready:
+                        return
+
+        raise CommandError(f"Timeout waiting for pod {pod} to be ready")
+
+    @staticmethod
+    def _path(resource: str, namespace: Optional[str] = None) -> str:
+        # core api group only
+        if namespace:
+            return f"/api/v1/namespaces/{namespace}/{resource}"
+
+        return f"/api/v1/{resource}"
+
+    def _request(self, method: str, path: str, **kwargs: Any) -> "requests.Response":
+        import requests
+
+        kwargs.setdefault("timeout", self.se.timeout)
+
+        session = self._get_session()
+        try:
+            response = session.request(method, self._server + path, **kwargs)
+        except requests.exceptions.RequestException as exc:
+            raise CommandError(f"{method} {path} failed: {exc}")
+
+        if not response.ok:
+            raise CommandError(
+                f"{method} {path} failed ({response.status_code}): {response.text}"
+            )
+
+        return response
+
+    def _get_session(self) -> "requests.Session":
+        with self._lock:
+            if not self._session:
+                self._session = self._create_session()
+
+            return self._session
+
+    def _create_session(self) -> "requests.Session":
+        import requests
+        import requests.adapters
+
+        config = json.loads(
+            _run_json(
+                f"kubectl config view --raw --minify -o json --kubeconfig={str(self.se.kubeconfig)}"
+            )[0]
+        )
+        cluster = config["clusters"][0]["cluster"]
+        user = config["users"][0]["user"]
+
+        self._server = cluster["server"].rstrip("/")
+
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.se.pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+
+        if "certificate-authority-data" in cluster:
+            session.verify = self._write_cert(
+                "ca.crt", cluster["certificate-authority-data"]
+            )
+        elif "certificate-authority" in cluster:
+            session.verify = cluster["certificate-authority"]
+
+        if cluster.get("insecure-skip-tls-verify"):
+            session.verify = False
+
+        if "client-certificate-data" in user:
+            session.cert = (
+                self._write_cert("client.crt", user["client-certificate-data"]),
+                self._write_cert("client.key", user["client-key-data"]),
+            )
+        elif "client-certificate" in user:
+            session.cert = (user["client-certificate"], user["client-key"])
+
+        if "token" in user:
+            session.headers["Authorization"] = f"Bearer {user['token']}"
+
+        return session
+
+    def _write_cert(self, name: str, data: str) -> str:
+        # requests only takes certificates as files
+        path = Path(self._certs_dir.name) / name
+        path.touch(mode=0o600)
+        path.write_bytes(base64.b64decode(data))
+        return str(path)
+
+
+class KubeState:
+    """
+    Snapshot of cluster state shared by queries.
+
+    Each part (namespaces, releases, nodes) is fetched once and dropped when it's mutated.
+    """
+
+    def __init__(self) -> None:
+        self._parts: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    def get(self, part: str, fetch: Callable[[], T]) -> T:
+        # fetching under the lock so concurrent deploys don't query the same thing twice
+        with self._lock:
+            if part not in self._parts:
+                self._parts[part] = fetch()
+            ret: T = self._parts[part]
+            return ret
+
+    def invalidate(self, part: str) -> None:
+        with self._lock:
+            self._parts.pop(part, None)
+
 
 class Kube:
+    # set only while in cached_state context
+    state: Optional[KubeState] = None
+
+    backend: KubectlBackend = KubectlBackend()
+
+    @classmethod
+    @contextmanager
+    def cached_state(cls) -> Iterator[KubeState]:
+        """
+        Cache cluster queries for the time of the context (eg. a deploy).
+        """
+        cls.state = KubeState()
+        try:
+            yield cls.state
+        finally:
+            cls.state = None
+
+    @classmethod
+    def query(cls, part: str, fetch: Callable[[], T]) -> T:
+        if cls.state:
+            return cls.state.get(part, fetch)
+
+        return fetch()
+
+    @classmethod
+    def invalidate(cls, part: str) -> None:
+        if cls.state:
+            cls.state.invalidate(part)
+
+    @staticmethod
+    def get(
+        resource: str,
+        item_type: Type[K],
+        namespace: Optional[str] = None,
+        selector: Optional[str] = None,
+    ) -> KubeList[K]:
+        return KubeList(Kube.backend.get(resource, namespace, selector), item_type)
+
     class Node:
         @classmethod
         def is_all_ready(cls) -> bool:
-            status = run("kubectl get nodes")[0]
-            return "NotReady" not in status
+            # not cached, used for polling
+            return all(n.is_ready for n in Kube.get("nodes", NodeObject))
+
+        @classmethod
+        def list(cls) -> KubeList[NodeObject]:
+            return Kube.query("nodes", lambda: Kube.get("nodes", NodeObject))
+
+        @classmethod
+        def wait_until_ready(cls, timeout: float) -> None:
+            """
+            Block until all nodes report Ready.
+
+            :raises WaitTimeout:
+            """
+            deadline = time.monotonic() + timeout
+
+            # kubectl wait fails right away if no nodes have registered yet
+            wait_until(
+                lambda: len(Kube.get("nodes", NodeObject)) != 0,
+                timeout=timeout,
+                description="nodes to register",
+            )
+
+            remaining = max(1, int(deadline - time.monotonic()))
+            try:
+                run(
+                    f"kubectl wait --for=condition=Ready nodes --all --timeout={remaining}s"
+                )
+            except CommandError as exc:
+                raise WaitTimeout(f"Timeout waiting for nodes to be ready: {exc}")
 
     class Namespace:
         @classmethod
         def list(cls) -> List[str]:
-            raw = run("kubectl get namespaces")[0].splitlines()[1:]
-            # skip header
-            ret = []
-            for r in list(raw):
-                ret.append(r.split()[0])
-
-            return ret
+            return Kube.query(
+                "namespaces", lambda: Kube.get("namespaces", KubeObject)
+            ).names
 
         @classmethod
         def create(cls, name: str) -> None:
-            run(f"kubectl create namespace {name}")
+            Kube.backend.create_namespace(name)
+            Kube.invalidate("namespaces")
+
+        @classmethod
+        def delete(cls, names: List[str], timeout: float) -> None:
+            """
+            Delete namespaces at once and wait for all of them with a single watch.
+
+            :raises WaitTimeout:
+            """
+            run(
+                f"kubectl delete namespace {' '.join(names)} --ignore-not-found --wait=false"
+            )
+            Kube.invalidate("namespaces")
+
+            resources = " ".join(f"namespace/{n}" for n in names)
+            try:
+                run(f"kubectl wait --for=delete {resources} --timeout={int(timeout)}s")
+            except CommandError as exc:
+                # older kubectl fails on namespaces that are gone before the watch starts
+                remaining = set(names) & set(Kube.get("namespaces", KubeObject).names)
+                if remaining:
+                    raise WaitTimeout(
+                        f"Timeout waiting for {', '.join(sorted(remaining))} to be deleted: {exc}"
+                    )
+
+    class Release:
+        @classmethod
+        def list(cls) -> Set[str]:
+            return set(cls.get_revisions())
+
+        @classmethod
+        def get_revisions(cls) -> Dict[str, str]:
+            """
+            :return: Dict[release name, revision]
+            """
+
+            def fetch() -> Dict[str, str]:
+                releases = json.loads(_run_json("helm ls --all-namespaces -o json")[0])
+                return {r["name"]: str(r["revision"]) for r in releases}
+
+            return Kube.query("releases", fetch)
 
 
 class HelmRelease:
@@ -50,6 +517,36 @@ class HelmRelease:
         self.release_name = release_name
         self.namespaced_name = f"""{self.li.namespace.name + "-" if self.li.namespace.name else ""}{release_name}"""
 
+    # set by skipping_unchanged(), installs (and skaffold deploys) are skipped when the
+    # fingerprint didn't change
+    skip_unchanged = False
+
+    @classmethod
+    @contextmanager
+    def skipping_unchanged(cls) -> Iterator[None]:
+        cls.skip_unchanged = True
+        try:
+            yield
+        finally:
+            cls.skip_unchanged = False
+
+    def get_fingerprint(self, chart: str, values: Path, version: Optional[str]) -> str:
+        """
+        Hash of everything that goes into a release.
+        """
+        sha256 = hashlib.sha256()
+        sha256.update(f"{self.namespaced_name}:{chart}:{version}".encode("utf-8"))
+        sha256.update(values.read_bytes())
+
+        # local chart
+        chart_dir = Path(chart)
+        if chart_dir.is_dir():
+            for f in sorted(p for p in chart_dir.rglob("*") if p.is_file()):
+                sha256.update(str(f.relative_to(chart_dir)).encode("utf-8"))
+                sha256.update(f.read_bytes())
+
+        return sha256.hexdigest()
+
     def install(
         self,
         chart: str,
@@ -65,6 +562,24 @@ class HelmRelease:
         :param version: install default if None
         :param upgrade: Try to upgrade when True. Delete and install when False.
         """
+        # charts might depend on batched manifests (secrets, configmaps)
+        self.li.namespace.flush()
+
+        fingerprint = self.get_fingerprint(chart, values, version)
+        if self.skip_unchanged and upgrade and self._is_unchanged(fingerprint):
+            logger.info(f"{self.namespaced_name} is up to date, skipping")
+            return
+
+        with profiler.span(f"helm install {self.namespaced_name}", chart=chart):
+            self._install(chart, values, version, upgrade, repo)
+
+        Kube.invalidate("releases")
+        if self.skip_unchanged:
+            self._save_fingerprint(fingerprint)
+
+    def _install(
+        self, chart: str, values: Path, version: Optional[str], upgrade: bool, repo: str
+    ) -> None:
         if not upgrade:
             try:
                 run(f"""helm delete --purge {self.namespaced_name}""")
@@ -87,17 +602,31 @@ class HelmRelease:
             """
         )
 
+    def _save_fingerprint(self, fingerprint: str) -> None:
+        # installs without skipping don't record fingerprints, but they bump the revision
+        try:
+            revision = Kube.Release.get_revisions()[self.namespaced_name]
+            self.li.namespace.save_fingerprint(
+                self.release_name, f"{fingerprint}:{revision}"
+            )
+        except (CommandError, KeyError) as exc:
+            logger.warning(
+                f"Couldn't save fingerprint of {self.namespaced_name} ({exc!r}), "
+                "it won't be skipped next time"
+            )
+
+    def _is_unchanged(self, fingerprint: str) -> bool:
+        revision = Kube.Release.get_revisions().get(self.namespaced_name)
+        deployed = self.li.namespace.get_fingerprints().get(self.release_name)
+        return revision is not None and deployed == f"{fingerprint}:{revision}"
+
     def delete(self) -> None:
         logger.info(f"Deleting {self.namespaced_name}")
         run(f"helm delete --purge {self.namespaced_name}")
+        Kube.invalidate("releases")
 
     def exists(self) -> bool:
-        try:
-            run(f"helm ls | grep {self.namespaced_name}")
-        except CommandError:
-            return False
-        else:
-            return True
+        return self.namespaced_name in Kube.Release.list()
 
 
 class Pod:
@@ -128,59 +657,289 @@ class Pod:
             src_path=src_path, dst_path=f"{self.se.name}:{dst_path}"
         )
 
+    def dump(self, command: str, dst: Path) -> None:
+        """
+        Stream command output to a local file, see dumps.dump.
+        """
+        dumps.dump(self.li.app.li.namespace.name, self.se.name, command, dst)
+
+    def restore(self, command: str, src: Path) -> None:
+        """
+        Stream a local file to command input, see dumps.restore.
+        """
+        dumps.restore(self.li.app.li.namespace.name, self.se.name, command, src)
+
 
 class Namespace:
-    apps: typing.OrderedDict[str, "App"]
+    fingerprints_configmap = "pangea-deploy-fingerprints"
 
     def __init__(self, name: str) -> None:
         self.name = name
-        self.apps = OrderedDict()
+
+        # apps are imported and validated only when first used
+        self._app_loaders: Dict[str, Callable[[], "App"]] = OrderedDict()
+        self._apps: Dict[str, "App"] = {}
+
+        # manifest files collected by apply_yaml while batching
+        self._pending: List[str] = []
+        self._batch_depth = 0
+        self._pending_lock = threading.Lock()
+        # held for the whole apply so nobody sees the manifests gone before they're applied
+        self._flush_lock = threading.Lock()
 
     def add_app(self, app: "App") -> None:
-        self.apps[app.env.get_name()] = app
-        i: Tuple[str, App]
-        self.apps = OrderedDict(
-            sorted(self.apps.items(), key=lambda i: i[1].env.deploy_priority)
+        self._apps[app.env.get_name()] = app
+
+    def add_app_loader(self, name: str, loader: Callable[[], "App"]) -> None:
+        self._app_loaders[name] = loader
+
+    def get_app(self, name: str) -> "App":
+        if name not in self._apps:
+            self._apps[name] = self._app_loaders[name]()
+
+        return self._apps[name]
+
+    @property
+    def app_names(self) -> List[str]:
+        return list(OrderedDict.fromkeys([*self._app_loaders, *self._apps]))
+
+    @property
+    def apps(self) -> typing.OrderedDict[str, "App"]:
+        """
+        All apps sorted by deploy priority. Loads every app.
+        """
+        apps = [self.get_app(n) for n in self.app_names]
+        return OrderedDict(
+            (a.env.get_name(), a)
+            for a in sorted(apps, key=lambda a: a.env.deploy_priority)
         )
 
+    def __getattr__(self, name: str) -> "App":
+        # lets fire reach apps as namespace attributes
+        # private names are never apps, also avoids recursion before __init__ is done
+        if not name.startswith("_") and name in self.app_names:
+            return self.get_app(name)
+
+        raise AttributeError(name)
+
+    def __dir__(self) -> List[str]:
+        return [*super().__dir__(), *self.app_names]
+
     def exists(self) -> bool:
         return self.name in Kube.Namespace.list()
 
+    def get_fingerprints(self) -> Dict[str, str]:
+        """
+        :return: Dict[release name, fingerprint] of releases deployed to this namespace
+        """
+
+        def fetch() -> Dict[str, str]:
+            raw = _run_json(
+                f"kubectl get configmap {self.fingerprints_configmap} "
+                f"--namespace={self.name} --ignore-not-found -o json"
+            )
+            if not raw:
+                return {}
+            fingerprints: Dict[str, str] = json.loads(raw[0]).get("data", {})
+            return fingerprints
+
+        return Kube.query(f"fingerprints/{self.name}", fetch)
+
+    def save_fingerprint(self, release_name: str, fingerprint: str) -> None:
+        # merge patch only touches one key so concurrent deploys don't overwrite each other
+        patch = json.dumps({"data": {release_name: fingerprint}})
+        command = (
+            f"kubectl patch configmap {self.fingerprints_configmap} "
+            f"--namespace={self.name} --type=merge -p '{patch}'"
+        )
+        try:
+            run(command)
+        except CommandError:
+            # might have been created by a concurrent deploy in the meantime
+            run(
+                f"kubectl create configmap {self.fingerprints_configmap} --namespace={self.name}",
+                ignore_errors=True,
+            )
+            run(command)
+
+        Kube.invalidate(f"fingerprints/{self.name}")
+
     def deploy_app(self, app_name: str) -> None:
         self.create()
-        self.apps[app_name].deploy()
+        self.get_app(app_name).deploy()
 
     def delete(self) -> None:
         logger.info(f"Deleting namespace {self.name}")
         run(f"kubectl delete namespace {self.name}")
+        Kube.invalidate("namespaces")
 
     def kubectl(self, command: str, print_output: bool = False) -> List[str]:
         return run(f"kubectl -n {self.name} {command}", print_output=print_output)
 
     def exec(self, pod: str, command: str, print_output: bool = False) -> List[str]:
-        return self.kubectl(
-            f'exec {pod} -- bash -c "{command}"', print_output=print_output
-        )
+        return Kube.backend.exec(self.name, pod, command, print_output=print_output)
 
-    def apply_yaml(self, filename: str) -> None:
-        self.kubectl(f"apply -f {filename}")
+    def apply_yaml(self, *filenames: str) -> None:
+        """
+        Apply manifests. They are only collected when batching and applied on flush.
+        """
+        with self._pending_lock:
+            if self._batch_depth:
+                self._pending.extend(filenames)
+                return
+
+        self.kubectl("apply " + " ".join(f"-f {f}" for f in filenames))
 
-    def delete_yaml(self, filename: str) -> None:
+    def delete_yaml(self, *filenames: str) -> None:
         """
-        Delete object specified in a yaml file.
+        Delete objects specified in yaml files.
 
-        :param filename: yaml file
+        :param filenames: yaml files
         :return:
         """
-        self.kubectl(f"delete -f k8s/{filename}")
+        self.kubectl("delete " + " ".join(f"-f k8s/{f}" for f in filenames))
+
+    @contextmanager
+    def batch(self) -> Iterator[None]:
+        """
+        Collect manifests passed to apply_yaml and apply them in one go on exit.
+
+        Manifests are dropped if the outermost batch exits with an exception so they
+        don't end up in an unrelated batch later.
+        """
+        with self._pending_lock:
+            self._batch_depth += 1
+
+        try:
+            yield
+        except BaseException:
+            with self._pending_lock:
+                self._batch_depth -= 1
+                if self._batch_depth == 0:
+                    self._pending = []
+            raise
+
+        with self._pending_lock:
+            self._batch_depth -= 1
+            last = self._batch_depth == 0
+
+        if last:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Apply manifests collected so far with a single kubectl apply.
+
+        Waits for a flush already in progress, so manifests queued before the call are
+        applied when it returns.
+        """
+        with self._flush_lock:
+            with self._pending_lock:
+                filenames, self._pending = list(dict.fromkeys(self._pending)), []
+
+            if filenames:
+                self.kubectl("apply " + " ".join(f"-f {f}" for f in filenames))
 
     def copy(self, src_path: str, dst_path: str) -> None:
-        self.kubectl(f"cp {src_path} {dst_path}")
+        Kube.backend.copy(self.name, src_path, dst_path)
+
+    def get_pods(self, selector: Optional[str] = None) -> List[str]:
+        """
+        :param selector: label selector, eg. "app=postgres"
+        """
+        return Kube.get("pods", PodObject, namespace=self.name, selector=selector).names
+
+    def exec_all(
+        self,
+        selector: str,
+        command: str,
+        timeout: int = 60,
+        workers: int = 8,
+        print_output: bool = False,
+        ignore_errors: bool = False,
+    ) -> Dict[str, PodResult]:
+        """
+        Run a command in all pods matching a label selector concurrently.
+
+        :param timeout: Per pod timeout in seconds.
+        :param ignore_errors: Return failures in results instead of raising.
+        :return: Dict[pod name, result]
+        """
+
+        def exec_pod(pod: str) -> List[str]:
+            return Kube.backend.exec(
+                self.name, pod, command, print_output=print_output, timeout=timeout
+            )
+
+        return self._fan_out(selector, exec_pod, workers, ignore_errors)
+
+    def copy_to_pods(
+        self,
+        selector: str,
+        src_path: str,
+        dst_path: str,
+        timeout: int = 60,
+        workers: int = 8,
+        ignore_errors: bool = False,
+    ) -> Dict[str, PodResult]:
+        """
+        Copy a local file to all pods matching a label selector concurrently.
+        """
+
+        def copy_pod(pod: str) -> List[str]:
+            Kube.backend.copy(self.name, src_path, f"{pod}:{dst_path}", timeout=timeout)
+            return []
+
+        return self._fan_out(selector, copy_pod, workers, ignore_errors)
+
+    def copy_from_pods(
+        self,
+        selector: str,
+        src_path: str,
+        dst_dir: Path,
+        timeout: int = 60,
+        workers: int = 8,
+        ignore_errors: bool = False,
+    ) -> Dict[str, PodResult]:
+        """
+        Copy a file from all pods matching a label selector to dst_dir/<pod name>.
+        """
+        dst_dir.mkdir(parents=True, exist_ok=True)
 
-    def get_pods(self) -> List[str]:
-        return [
-            p.metadata.name for p in self.li.kube.list_namespaced_pod(self.name).items
-        ]
+        def copy_pod(pod: str) -> List[str]:
+            Kube.backend.copy(
+                self.name, f"{pod}:{src_path}", str(dst_dir / pod), timeout=timeout
+            )
+            return []
+
+        return self._fan_out(selector, copy_pod, workers, ignore_errors)
+
+    def _fan_out(
+        self,
+        selector: str,
+        fun: Callable[[str], List[str]],
+        workers: int,
+        ignore_errors: bool,
+    ) -> Dict[str, PodResult]:
+        pods = self.get_pods(selector)
+        if not pods:
+            raise CommandError(f'No pods matching "{selector}" in {self.name}')
+
+        def call(pod: str) -> PodResult:
+            with prefixed_output(f"[{pod}] "):
+                try:
+                    return PodResult(pod=pod, output=fun(pod))
+                except CommandError as exc:
+                    return PodResult(pod=pod, output=[], error=str(exc))
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = {r.pod: r for r in executor.map(call, pods)}
+
+        failed = [r for r in results.values() if not r.ok]
+        if failed and not ignore_errors:
+            raise CommandError("\n".join(f"{r.pod}: {r.error}" for r in failed))
+
+        return results
 
     def wait_for_pod(self, pod_name: str, timeout: int = 20) -> None:
         """
@@ -188,7 +947,7 @@ class Namespace:
         :param timeout: Timeout in seconds
         :return:
         """
-        self.kubectl(f"wait --for=condition=ready pod {pod_name} --timeout={timeout}s")
+        Kube.backend.wait_for_pod(self.name, pod_name, timeout)
 
     def _add_pullsecret(self) -> None:
         env = self.env
@@ -0,0 +1,201 @@
+import atexit
+import functools
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, TypeVar, cast
+
+from loguru import logger
+
+import environ
+
+environ = environ.Env()
+
+__all__ = ["Profiler", "Span", "enable", "disable", "get", "span", "profiled"]
+
+
+@dataclass
+class Span:
+    name: str
+    start: float
+    thread_id: int
+    args: Dict[str, Any]
+    end: float = 0.0
+    children: List["Span"] = field(default_factory=list)
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+
+class Profiler:
+    """
+    Collects timing spans into a tree.
+
+    Spans opened in worker threads that have no open span of their own are attached to
+    the innermost open span of the thread that created the profiler, which is the one
+    that started the pool.
+    """
+
+    def __init__(self) -> None:
+        self.root = Span(
+            name="pangea",
+            start=time.perf_counter(),
+            thread_id=threading.get_ident(),
+            args={},
+        )
+
+        self._local = threading.local()
+        self._main_stack = self._get_stack()
+        self._lock = threading.Lock()
+
+    def _get_stack(self) -> List[Span]:
+        stack: List[Span] = self._local.__dict__.setdefault("stack", [])
+        return stack
+
+    @contextmanager
+    def span(self, name: str, **args: Any) -> Iterator[Span]:
+        stack = self._get_stack()
+
+        if stack:
+            parent = stack[-1]
+        elif self._main_stack:
+            parent = self._main_stack[-1]
+        else:
+            parent = self.root
+
+        s = Span(
+            name=name,
+            start=time.perf_counter(),
+            thread_id=threading.get_ident(),
+            args=args,
+        )
+        with self._lock:
+            parent.children.append(s)
+
+        stack.append(s)
+        try:
+            yield s
+        finally:
+            s.end = time.perf_counter()
+            stack.pop()
+
+    def format_tree(self) -> str:
+        """
+        Sibling spans with the same name are merged and show a call count.
+        """
+        self.root.end = time.perf_counter()
+        lines = [f"{self.root.duration:8.2f}s {self.root.name}"]
+
+        def walk(spans: List[Span], depth: int) -> None:
+            groups: Dict[str, List[Span]] = OrderedDict()
+            for s in spans:
+                groups.setdefault(s.name, []).append(s)
+
+            for name, group in groups.items():
+                total = sum(s.duration for s in group)
+                count = f" (x{len(group)})" if len(group) > 1 else ""
+                lines.append(f"{'  ' * depth}{total:8.2f}s {name}{count}")
+                walk([c for s in group for c in s.children], depth + 1)
+
+        walk(self.root.children, 1)
+        return "\n".join(lines)
+
+    def to_chrome_trace(self) -> Dict[str, Any]:
+        """
+        Trace in Chrome trace event format (chrome://tracing, Perfetto, speedscope).
+        """
+        pid = os.getpid()
+        events = []
+
+        def walk(span: Span) -> None:
+            for c in span.children:
+                events.append(
+                    {
+                        "name": c.name,
+                        "ph": "X",
+                        "ts": (c.start - self.root.start) * 1e6,
+                        "dur": c.duration * 1e6,
+                        "pid": pid,
+                        "tid": c.thread_id,
+                        "args": c.args,
+                    }
+                )
+                walk(c)
+
+        walk(self.root)
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def save(self, path: Path) -> None:
+        path.write_text(json.dumps(self.to_chrome_trace(), default=str))
+
+
+_profiler: Optional[Profiler] = None
+
+
+def get() -> Optional[Profiler]:
+    return _profiler
+
+
+def enable(trace_file: Optional[Path] = None) -> Profiler:
+    """
+    :param trace_file: Where to save the trace at exit. Only the timing tree is logged if None.
+    """
+    global _profiler
+    disable()
+    _profiler = Profiler()
+    atexit.register(_report, _profiler, trace_file)
+    return _profiler
+
+
+def disable() -> None:
+    global _profiler
+    _profiler = None
+    atexit.unregister(_report)
+
+
+def _report(profiler: Profiler, trace_file: Optional[Path]) -> None:
+    logger.info(f"Timings:\n{profiler.format_tree()}")
+
+    if trace_file:
+        profiler.save(trace_file)
+        logger.info(f"Trace saved to {str(trace_file)}")
+
+
+@contextmanager
+def span(name: str, **args: Any) -> Iterator[None]:
+    """
+    Time a block. Does nothing if profiling is disabled.
+    """
+    if not _profiler:
+        yield
+        return
+
+    with _profiler.span(name, **args):
+        yield
+
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+
+def profiled(func: F) -> F:
+    @functools.wraps(func)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        with span(f"{func.__module__}.{func.__qualname__}"):
+            return func(*args, **kwargs)
+
+    return cast(F, wrapper)
+
+
+# PG_PROFILE=1 logs timings, any other value is also used as the trace file path
+if environ.str("PG_PROFILE", ""):
+    enable(
+        None
+        if environ.str("PG_PROFILE") == "1"
+        else Path(environ.str("PG_PROFILE")).absolute()
+    )
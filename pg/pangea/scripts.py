@@ -46,21 +46,22 @@ class Pangea:
         current_dir = Path(".").absolute()
 
         cluster_file = Path("cluster.py")
-        comm.render_py_file(
-            pkg_vars.templates_dir / "cluster.py.templ", cluster_file, self.context
-        )
-        comm.render_py_file(
-            pkg_vars.templates_dir / "env_comm.py.templ",
-            Path("env_comm.py"),
-            self.context,
-        )
+        with comm.batch_format():
+            comm.render_py_file(
+                pkg_vars.templates_dir / "cluster.py.templ", cluster_file, self.context
+            )
+            comm.render_py_file(
+                pkg_vars.templates_dir / "env_comm.py.templ",
+                Path("env_comm.py"),
+                self.context,
+            )
+
+            self.create_env("local")
+            self.create_env("test")
+            self.create_env("stage")
 
         cluster_file.chmod(0o777)
 
-        self.create_env("local")
-        self.create_env("test")
-        self.create_env("stage")
-
         bin_dir = Path(".bin")
         Path(".deps").mkdir()
         bin_dir.mkdir()
@@ -78,7 +79,7 @@ class Pangea:
         Cluster = import_module(f"{current_dir.name}.cluster").Cluster
         Cluster.createapp("ingress", "system", "ingress")
 
-        sys.path.pop()
+        sys.path.remove(str(current_dir.parent))
 
         logger.info('Activate 🐣 local environment with "envo"')
 
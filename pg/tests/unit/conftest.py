@@ -1,4 +1,5 @@
 import inspect
+import json
 import os
 from pathlib import Path
 from typing import List
@@ -8,6 +9,7 @@ from tests.unit import utils
 import pytest_socket
 from envo import Env
 from pangea.cluster import Cluster
+from pangea.deps import BinaryDep
 from pytest import fixture
 from unit import utils
 
@@ -47,38 +49,54 @@ def mock_run(mocker, cluster_ip) -> None:
         print_output: bool = False,
         progress_bar: bool = False,
     ) -> List[str]:
-        if command == "kubectl describe nodes sandbox-test":
-            return ret(
-                f"""
-            Addresses:
-              InternalIP:  {cluster_ip}
-              Hostname:    sandbox-test-control-plane
-            Capacity:"""
-            )
-        if command == "kubectl get nodes":
-            return ret(
-                """
-                NAME                         STATUS     ROLES    AGE   VERSION
-                sandbox-test-control-plane   Ready      master   12s   v1.15.7
-                """
-            )
-
-        if command == "kubectl get namespaces":
-            return ret(
-                """
-            NAME                 STATUS   AGE
-            aux                  Active   9h
-            default              Active   10h
-            flesh                Active   9h
-            kube-node-lease      Active   10h
-            kube-public          Active   10h
-            kube-system          Active   10h
-            local-path-storage   Active   10h
-            system               Active   10h
-            """
-            )
+        # json queries send stderr to a file
+        command = command.split(" 2>")[0]
+
+        if command == "kubectl get nodes -o json":
+            node = {
+                "metadata": {"name": "sandbox-test-control-plane"},
+                "status": {
+                    "addresses": [
+                        {"address": cluster_ip, "type": "InternalIP"},
+                        {"address": "sandbox-test-control-plane", "type": "Hostname"},
+                    ],
+                    "conditions": [{"status": "True", "type": "Ready"}],
+                },
+            }
+            return [json.dumps({"items": [node]}, indent=4)]
+
+        if command == "kubectl get namespaces -o json":
+            namespaces = [
+                "aux",
+                "default",
+                "flesh",
+                "kube-node-lease",
+                "kube-public",
+                "kube-system",
+                "local-path-storage",
+                "system",
+            ]
+            return [
+                json.dumps(
+                    {"items": [{"metadata": {"name": n}} for n in namespaces]},
+                    indent=4,
+                )
+            ]
+        if command == "helm ls --all-namespaces -o json":
+            return ["[]"]
         return []
 
+    def install(self: BinaryDep) -> None:
+        # nothing gets downloaded with run mocked
+        self.bin_file.touch()
+
+    mocker.patch.object(BinaryDep, "install", install)
+
+    docker_client = mocker.patch("docker.from_env").return_value
+    docker_client.images.list.return_value = []
+    docker_client.containers.list.return_value = []
+    docker_client.containers.run.return_value.status = "running"
+
     magic_mock1 = mocker.patch("sandbox.cluster.cluster.run")
     magic_mock1.side_effect = run
     magic_mock2 = mocker.patch("pangea.kube.run")
@@ -1,9 +1,50 @@
+import gzip
+import json
+import os
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
 from pathlib import Path
+from threading import Barrier, Event, Thread
+from typing import Callable, Dict, List
+from unittest.mock import Mock
+from urllib.parse import parse_qs, urlparse
 
 import pytest
+import pytest_socket
+from pangea import apps, dumps, kube, profiler
+from pangea.apps import Dockerfile, ImageBuilder, SkaffoldApp
+from pangea.cache import DownloadCache
 from pangea.cluster import Cluster
 from pangea.comm.test_utils import flake8
-from pangea.kube import Kube
+from pangea.deps import BinaryDep, DnsServer, DockerDep
+from pangea.devops import (
+    CommandError,
+    CommandTimeout,
+    PipeShell,
+    PtyShell,
+    Shell,
+    WaitTimeout,
+    prefixed_output,
+    run,
+    run_iter,
+    shell_pool,
+    wait_until,
+)
+from pangea.kube import (
+    ApiBackend,
+    HelmRelease,
+    Kube,
+    KubeList,
+    KubeObject,
+    Namespace,
+    NodeObject,
+)
+from pangea.profiler import Profiler
 
 from . import utils
 from .utils import command
@@ -32,13 +73,1192 @@ class TestKube:
         assert Kube.Node.is_all_ready()
 
         magic_mock2 = mocker.patch("pangea.kube.run")
-        magic_mock2.return_value = [
-            """NAME                         STATUS     ROLES    AGE   VERSION
-               sandbox-test-control-plane   NotReady   master   12s   v1.15.7"""
-        ]
+        node = {
+            "metadata": {"name": "sandbox-test-control-plane"},
+            "status": {"conditions": [{"status": "False", "type": "Ready"}]},
+        }
+        magic_mock2.return_value = [json.dumps({"items": [node]})]
 
         assert not Kube.Node.is_all_ready()
 
+    def test_kube_list(self):
+        raw = json.dumps(
+            {
+                "items": [
+                    {
+                        "metadata": {"name": "node1"},
+                        "status": {
+                            "addresses": [
+                                {"address": "10.0.0.1", "type": "InternalIP"}
+                            ],
+                            "conditions": [{"status": "True", "type": "Ready"}],
+                        },
+                    }
+                ]
+            }
+        )
+        nodes = KubeList(raw, NodeObject)
+        assert "items" not in nodes.__dict__
+
+        assert nodes.names == ["node1"]
+        assert nodes.items[0].is_ready
+        assert nodes.items[0].get_address("InternalIP") == "10.0.0.1"
+        assert nodes.items[0].get_address("ExternalIP") is None
+
+    def test_batched_apply(self):
+        namespace = Namespace("flesh")
+        applied = []
+
+        def kubectl(command: str, print_output: bool = False) -> List[str]:
+            applied.append(command)
+            return []
+
+        namespace.kubectl = kubectl
+
+        with namespace.batch():
+            namespace.apply_yaml("secret.yaml")
+            namespace.apply_yaml("configmap.yaml", "secret.yaml")
+            assert applied == []
+
+        assert applied == ["apply -f secret.yaml -f configmap.yaml"]
+
+        namespace.apply_yaml("k8s")
+        assert applied[1:] == ["apply -f k8s"]
+
+        with pytest.raises(CommandError):
+            with namespace.batch():
+                namespace.apply_yaml("secret.yaml")
+                raise CommandError("helm failed")
+
+        with namespace.batch():
+            namespace.apply_yaml("configmap.yaml")
+
+        assert applied[2:] == ["apply -f configmap.yaml"]
+
+    def test_flush_waits_for_apply(self):
+        namespace = Namespace("flesh")
+        applying = Event()
+        applied = Event()
+
+        def kubectl(command: str, print_output: bool = False) -> List[str]:
+            applying.set()
+            applied.wait(timeout=5)
+            return []
+
+        namespace.kubectl = kubectl
+
+        with namespace.batch():
+            namespace.apply_yaml("secret.yaml")
+            first = Thread(target=namespace.flush)
+            first.start()
+            applying.wait(timeout=5)
+
+            # e.g. another helm release of the same wave
+            second = Thread(target=namespace.flush)
+            second.start()
+            second.join(timeout=0.2)
+            assert second.is_alive()
+
+            applied.set()
+            first.join()
+            second.join()
+
+    def test_exec_all(self, mocker):
+        def run(command: str, **kwargs) -> List[str]:
+            if command.startswith(
+                "kubectl get pods --namespace=flesh --selector=app=db"
+            ):
+                pods = [{"metadata": {"name": n}} for n in ["db-0", "db-1", "db-2"]]
+                return [json.dumps({"items": pods})]
+            if "exec db-2" in command:
+                raise CommandError("timed out")
+            assert command.startswith("timeout 5 kubectl -n flesh exec")
+            return ["ok"]
+
+        mocker.patch("pangea.kube.run", side_effect=run)
+        namespace = Namespace("flesh")
+
+        with pytest.raises(CommandError) as exc:
+            namespace.exec_all("app=db", "vacuumdb", timeout=5)
+        assert str(exc.value) == "db-2: timed out"
+
+        results = namespace.exec_all(
+            "app=db", "vacuumdb", timeout=5, ignore_errors=True
+        )
+        assert [r.output for r in results.values()] == [["ok"], ["ok"], []]
+        assert not results["db-2"].ok
+
+    def test_lazy_apps(self):
+        def app(name: str, priority: int) -> Mock:
+            ret = Mock()
+            ret.env.get_name.return_value = name
+            ret.env.deploy_priority = priority
+            return ret
+
+        ingress = Mock(return_value=app("ingress", 200))
+        registry = Mock(return_value=app("registry", 100))
+
+        namespace = Namespace("system")
+        namespace.add_app_loader("ingress", ingress)
+        namespace.add_app_loader("registry", registry)
+
+        assert "registry" in dir(namespace)
+        namespace.registry.deploy()
+        namespace.registry.deploy()
+        assert registry.call_count == 1
+        assert not ingress.called
+
+        assert list(namespace.apps) == ["registry", "ingress"]
+        assert ingress.call_count == 1
+
+        with pytest.raises(AttributeError):
+            namespace.sentry
+
+    def test_delete_namespaces(self, mocker):
+        remaining = ["aux", "default"]
+
+        def run(command: str, **kwargs) -> List[str]:
+            if command.startswith("kubectl wait"):
+                raise CommandError("timed out waiting for the condition")
+            if command.split(" 2>")[0] == "kubectl get namespaces -o json":
+                items = [{"metadata": {"name": n}} for n in remaining]
+                return [json.dumps({"items": items})]
+            return []
+
+        run_mock = mocker.patch("pangea.kube.run", side_effect=run)
+
+        with pytest.raises(WaitTimeout) as exc:
+            Kube.Namespace.delete(["flesh", "aux"], timeout=30)
+        assert "aux to be deleted" in str(exc.value)
+
+        assert run_mock.call_args_list[:2] == [
+            mocker.call(
+                "kubectl delete namespace flesh aux --ignore-not-found --wait=false"
+            ),
+            mocker.call(
+                "kubectl wait --for=delete namespace/flesh namespace/aux --timeout=30s"
+            ),
+        ]
+
+        remaining.remove("aux")
+        Kube.Namespace.delete(["flesh", "aux"], timeout=30)
+
+    def test_cached_state(self):
+        run_mock = kube.run
+
+        with Kube.cached_state():
+            Kube.Namespace.list()
+            assert "system" in Kube.Namespace.list()
+            assert run_mock.call_count == 1
+
+            Kube.Namespace.create("new")
+            Kube.Namespace.list()
+            assert run_mock.call_count == 3
+
+        Kube.Namespace.list()
+        assert run_mock.call_count == 4
+
+    def test_skip_unchanged_release(self, mocker, tmp_path):
+        deployed: Dict[str, str] = {}
+
+        def run(command: str, **kwargs) -> List[str]:
+            if command.startswith("kubectl get configmap"):
+                return [json.dumps({"data": deployed})] if deployed else []
+            if command.startswith("kubectl patch configmap"):
+                deployed.update(json.loads(command.split("-p ")[1].strip("'"))["data"])
+            if command.split(" 2>")[0] == "helm ls --all-namespaces -o json":
+                release = {"name": "flesh-app", "revision": str(helm_installs())}
+                return [json.dumps([release])]
+            return []
+
+        run_mock = mocker.patch("pangea.kube.run", side_effect=run)
+        values = tmp_path / "values.yaml"
+        values.write_text("replicas: 1")
+        release = Namespace("flesh").helm("app")
+
+        def helm_installs() -> int:
+            return len(
+                [
+                    c
+                    for c in run_mock.call_args_list
+                    if c[0][0].startswith("helm upgrade")
+                ]
+            )
+
+        def kubectl_calls() -> int:
+            return len([c for c in run_mock.call_args_list if "kubectl" in c[0][0]])
+
+        with HelmRelease.skipping_unchanged():
+            release.install("stable/app", values=values)
+            release.install("stable/app", values=values)
+            assert helm_installs() == 1
+
+            values.write_text("replicas: 2")
+            release.install("stable/app", values=values)
+            assert helm_installs() == 2
+
+        # fingerprints are only recorded when skipping
+        kubectl_before = kubectl_calls()
+        values.write_text("replicas: 3")
+        release.install("stable/app", values=values)
+        assert helm_installs() == 3
+        assert kubectl_calls() == kubectl_before
+
+        # the release changed since the fingerprint was recorded
+        values.write_text("replicas: 2")
+        with HelmRelease.skipping_unchanged():
+            release.install("stable/app", values=values)
+            assert helm_installs() == 4
+
+    def test_fingerprint_not_saved(self, mocker, tmp_path):
+        def run(command: str, **kwargs) -> List[str]:
+            if command.startswith(("kubectl patch", "kubectl create")):
+                raise CommandError("forbidden")
+            if command.split(" 2>")[0] == "helm ls --all-namespaces -o json":
+                return [json.dumps([{"name": "flesh-app", "revision": "1"}])]
+            return []
+
+        mocker.patch("pangea.kube.run", side_effect=run)
+        warning = mocker.patch("pangea.kube.logger.warning")
+        values = tmp_path / "values.yaml"
+        values.write_text("replicas: 1")
+
+        with HelmRelease.skipping_unchanged():
+            # doesn't fail the install after helm succeeded
+            Namespace("flesh").helm("app").install("stable/app", values=values)
+
+        warning.assert_called_once()
+
+
+class TestApiBackend:
+    class FakeApiServer(BaseHTTPRequestHandler):
+        namespaces: List[str] = []
+
+        def do_GET(self) -> None:  # noqa: N802
+            assert self.headers["Authorization"] == "Bearer token"
+
+            url = urlparse(self.path)
+            if url.path == "/api/v1/nodes":
+                node = {
+                    "metadata": {"name": "node1"},
+                    "status": {"conditions": [{"status": "True", "type": "Ready"}]},
+                }
+                self._send({"items": [node]})
+            elif url.path == "/api/v1/namespaces/flesh/pods":
+                assert parse_qs(url.query)["watch"] == ["true"]
+                pod = {"metadata": {"name": "pod1"}, "status": {"conditions": []}}
+                events = [
+                    {"type": "ADDED", "object": pod},
+                    {
+                        "type": "MODIFIED",
+                        "object": {
+                            **pod,
+                            "status": {
+                                "conditions": [{"status": "True", "type": "Ready"}]
+                            },
+                        },
+                    },
+                ]
+                self._send_lines([json.dumps(e) for e in events])
+            else:
+                self.send_error(404)
+
+        def do_POST(self) -> None:  # noqa: N802
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            self.namespaces.append(body["metadata"]["name"])
+            self._send(body)
+
+        def _send(self, data: Dict) -> None:
+            self._send_lines([json.dumps(data)])
+
+        def _send_lines(self, lines: List[str]) -> None:
+            body = "\n".join(lines).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args) -> None:
+            pass
+
+    @pytest.fixture
+    def backend(self, sandbox, mocker, tmp_path) -> ApiBackend:
+        pytest_socket.enable_socket()
+        server = ThreadingHTTPServer(("127.0.0.1", 0), self.FakeApiServer)
+        Thread(target=server.serve_forever, daemon=True).start()
+
+        config = {
+            "clusters": [
+                {"cluster": {"server": f"http://127.0.0.1:{server.server_port}"}}
+            ],
+            "users": [{"user": {"token": "token"}}],
+        }
+        mocker.patch("pangea.kube.run", return_value=[json.dumps(config)])
+
+        backend = ApiBackend(ApiBackend.Sets(kubeconfig=tmp_path / "kubeconfig"))
+        mocker.patch.object(Kube, "backend", backend)
+        yield backend
+
+        server.shutdown()
+        server.server_close()
+
+    def test_get(self, backend):
+        assert Kube.Node.is_all_ready()
+        assert kube.run.call_count == 1
+
+        Kube.Node.is_all_ready()
+        # kubeconfig is read once
+        assert kube.run.call_count == 1
+
+    def test_create_namespace(self, backend):
+        Kube.Namespace.create("flesh")
+        assert self.FakeApiServer.namespaces == ["flesh"]
+
+    def test_wait_for_pod(self, backend):
+        Namespace("flesh").wait_for_pod("pod1")
+
+    def test_error(self, backend):
+        with pytest.raises(CommandError):
+            Kube.get("secrets", KubeObject)
+
+
+class TestDevops:
+    @pytest.fixture(autouse=True)
+    def setup(self, sandbox):
+        yield
+        shell_pool.close()
+
+    def test_shell_reused(self):
+        pid = run("echo $$")[0]
+        assert run("echo $$")[0] == pid
+
+    def test_cwd_restored(self):
+        cwd = run("pwd")[0]
+        assert run("cd /tmp\npwd") == ["/tmp"]
+        assert run("pwd")[0] == cwd
+
+    def test_mutated_shell_discarded(self):
+        pid = run("export PG_TEST_VAR=1\necho $$")[0]
+        assert run("echo $$")[0] != pid
+        assert run("echo $PG_TEST_VAR") == [""]
+
+    @pytest.mark.parametrize("print_output", [False, True])
+    @pytest.mark.parametrize(
+        "command,check",
+        [
+            ("PG_TEST_VAR=1", "echo ${PG_TEST_VAR:-unset}"),
+            ("set -o pipefail", "false | true"),
+            ("set -e", "false"),
+            ("shopt -s nullglob", "echo nothing*"),
+            ("trap 'echo trapped' DEBUG", "true"),
+            ("umask 077", "umask"),
+            ("ls() { echo hijacked; }", "type -t ls"),
+        ],
+    )
+    def test_mutated_state_discarded(self, command, check, print_output):
+        before = run(check, ignore_errors=True, print_output=print_output)
+        run(command, print_output=print_output)
+
+        assert run(check, ignore_errors=True, print_output=print_output) == before
+
+    @pytest.mark.parametrize("expired", [False, True])
+    def test_sudo_revalidated(self, mocker, monkeypatch, tmp_path, expired):
+        sudo = tmp_path / "sudo"
+        sudo.write_text(f"#!/bin/sh\nexit {int(expired)}\n")
+        sudo.chmod(0o755)
+        monkeypatch.setenv("PATH", f"{tmp_path}:{os.environ['PATH']}")
+
+        def grant_sudo(shell: PtyShell) -> None:
+            shell.sudo_granted = True
+
+        grant_mock = mocker.patch.object(
+            PtyShell, "grant_sudo", autospec=True, side_effect=grant_sudo
+        )
+
+        run("sudo true", ignore_errors=True)
+        run("sudo true", ignore_errors=True)
+        assert grant_mock.call_count == (2 if expired else 1)
+
+    @pytest.mark.parametrize("print_output", [False, True])
+    def test_timeout(self, monkeypatch, print_output):
+        pid = run("echo $$", print_output=print_output)[0]
+        monkeypatch.setattr(Shell, "timeout", 0.5)
+
+        start = time.monotonic()
+        with pytest.raises(CommandTimeout):
+            run("echo started\nsleep 5", print_output=print_output)
+        assert time.monotonic() - start < 3
+
+        # the shell is still busy, it can't go back to the pool
+        assert run("echo $$", print_output=print_output)[0] != pid
+
+    def test_exit_code(self):
+        with pytest.raises(CommandError):
+            run("true\nfalse")
+
+        assert run("(exit 3)\necho $?", ignore_errors=True) == ["3"]
+
+    def test_json_query_stderr(self):
+        # warnings kubectl prints to stderr don't end up in the parsed output
+        output = kube._run_json("sh -c 'echo Warning: deprecated >&2; echo {}'")
+        assert output == ["{}"]
+
+        with pytest.raises(CommandError) as exc:
+            kube._run_json("sh -c 'echo {}; echo forbidden >&2; exit 1'")
+        assert str(exc.value) == "forbidden\n"
+
+    def test_round_trips(self, mocker):
+        import pexpect
+
+        lines = 100
+        # warm up the pool
+        run("true", print_output=True)
+
+        sendline = mocker.spy(pexpect.spawn, "sendline")
+        run("\n".join(["true"] * lines), print_output=True)
+        sent = [c[0][1] for c in sendline.call_args_list]
+
+        # exit code comes with the prompt, no separate "echo $?" after every command
+        # (the first and last lines are the pool's health and state checks)
+        assert sent[1:-1] == ["true"] * lines
+        assert len(sent) == lines + 2
+
+    def test_pipe_shell(self):
+        output = "\n".join(str(i) for i in range(10000))
+        assert run("seq 0 9999\nprintf no-newline") == [output, "no-newline"]
+
+        shell = shell_pool.acquire(PipeShell)
+        assert shell.execute("cat")[0] == []
+        shell_pool.release(shell)
+
+    @pytest.mark.parametrize("print_output", [False, True])
+    def test_run_iter(self, print_output):
+        lines = run_iter("seq 1 3\necho done", print_output=print_output)
+        assert list(lines) == ["1", "2", "3", "done"]
+
+        with pytest.raises(CommandError) as exc:
+            list(run_iter("seq 1 1000\nfalse", error_lines=2))
+        assert str(exc.value) == ""
+
+        with pytest.raises(CommandError) as exc:
+            list(run_iter("seq 1 1000; false", error_lines=2))
+        assert str(exc.value) == "999\n1000"
+
+    def test_prefixed_output(self, capsys):
+        with prefixed_output("[app] "):
+            run("echo test", print_output=True)
+
+        assert capsys.readouterr().out == "[app] test\n"
+
+    def test_raw_output(self, capsys):
+        with prefixed_output("[app] "):
+            ret = run(
+                "printf '10%%\\r50%%\\r100%%\\n'\nprintf 'Continue? '",
+                print_output=True,
+            )
+
+        assert ret == ["10%\r50%\r100%", "Continue?"]
+        assert capsys.readouterr().out == (
+            "[app] 10%\r[app] 50%\r[app] 100%\n[app] Continue? \n"
+        )
+
+    @pytest.mark.parametrize(
+        "shell_type, end",
+        [(PtyShell, "##PG_PROMPT##7##"), (PipeShell, "##PG_EXIT_CODE##7\n")],
+    )
+    def test_end_split_across_chunks(self, shell_type, end):
+        # no need for a running bash, only the output is parsed
+        shell = shell_type.__new__(shell_type)
+        output = "hello\n##PG_\n" + end
+
+        # every cut, including inside the closing "##" of the prompt
+        for cut in range(1, len(output)):
+            chunks: List[str] = []
+            lines = list(
+                shell._split_output(iter([output[:cut], output[cut:]]), chunks.append)
+            )
+
+            assert lines == ["hello", "##PG_"], cut
+            assert "".join(chunks) == "hello\n##PG_\n", cut
+            assert shell.ret_code == 7
+
+    @pytest.mark.parametrize("shell_type", [PtyShell, PipeShell])
+    def test_output_streamed(self, shell_type):
+        chunks: List[str] = []
+        start = time.monotonic()
+
+        def on_output(text: str) -> None:
+            chunks.append(text)
+            if len(chunks) == 1:
+                # prompt shows up before the command finishes
+                assert time.monotonic() - start < 0.5
+
+        shell = shell_pool.acquire(shell_type)
+        command = "printf 'Continue? '; sleep 1; echo '##PG_'; printf done"
+        lines = list(shell.iter_lines(command, on_output))
+        shell_pool.release(shell)
+
+        assert chunks[0] == "Continue? "
+        assert "".join(chunks) == "Continue? ##PG_\ndone"
+        assert lines == ["Continue? ##PG_", "done"]
+
+    def test_run_iter_closed_early(self):
+        pid = run("echo $$")[0]
+
+        lines = run_iter("yes")
+        assert next(lines) == "y"
+        lines.close()
+
+        assert run("echo $$")[0] != pid
+
+    def test_wait_until(self):
+        calls = []
+
+        def condition() -> bool:
+            calls.append(time.monotonic())
+            return len(calls) == 4
+
+        start = time.monotonic()
+        wait_until(condition, timeout=5, description="condition")
+        # 0.05 + 0.1 + 0.2 of backoff
+        assert calls[-1] - start < 0.5
+
+        with pytest.raises(WaitTimeout):
+            wait_until(lambda: False, timeout=0.2, description="nothing")
+
+
+class TestDownloadCache:
+    @pytest.fixture
+    def download_cache(self, tmp_path) -> DownloadCache:
+        return DownloadCache(DownloadCache.Sets(root=tmp_path / "cache", max_size=10))
+
+    def test_put_get(self, download_cache, tmp_path):
+        src = tmp_path / "kubectl"
+        src.write_text("binary")
+        download_cache.put("kubectl-1.17.0", src)
+
+        dst = tmp_path / "dst"
+        assert download_cache.get("kubectl-1.17.0", dst)
+        assert dst.read_text() == "binary"
+
+        assert not download_cache.get("kubectl-1.18.0", tmp_path / "dst2")
+
+    def test_corrupted(self, download_cache, tmp_path):
+        src = tmp_path / "kubectl"
+        src.write_text("binary")
+        download_cache.put("kubectl-1.17.0", src)
+        # blob is hardlinked
+        src.write_text("changed")
+
+        assert not download_cache.get("kubectl-1.17.0", tmp_path / "dst")
+
+    def test_lru_eviction(self, download_cache, tmp_path):
+        def put(name: str) -> None:
+            src = tmp_path / name
+            src.write_text(name * 4)
+            download_cache.put(name, src)
+
+        put("a")
+        put("b")
+        download_cache.get("a", tmp_path / "a_dst")
+        put("c")
+
+        cached = [n for n in "abc" if download_cache.get(n, tmp_path / f"{n}_check")]
+        assert cached == ["a", "c"]
+
+
+class TestBinaryDep:
+    class Tool(BinaryDep):
+        name = "tool"
+
+    @pytest.fixture(autouse=True)
+    def download_cache(self, mocker, tmp_path) -> DownloadCache:
+        download_cache = DownloadCache(
+            DownloadCache.Sets(root=tmp_path / "cache", max_size=1024)
+        )
+        mocker.patch("pangea.cache.get_default", return_value=download_cache)
+        return download_cache
+
+    def tool(self, deps_dir: Path) -> "TestBinaryDep.Tool":
+        deps_dir.mkdir(exist_ok=True)
+        return self.Tool(self.Tool.Sets(deps_dir=deps_dir, version="1.0"))
+
+    def test_concurrent_install(self, mocker, tmp_path):
+        # both installs have to be downloading at the same time
+        barrier = Barrier(2, timeout=5)
+
+        def download(tmp_dir: Path) -> Path:
+            barrier.wait()
+            downloaded = tmp_dir / "tool"
+            downloaded.write_text("binary")
+            return downloaded
+
+        mocker.patch.object(self.Tool, "_download", side_effect=download)
+        tools = [self.tool(tmp_path / "deps") for _ in range(2)]
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            for f in [executor.submit(t.install) for t in tools]:
+                f.result()
+
+        assert tools[0].bin_file.read_text() == "binary"
+        assert os.access(str(tools[0].bin_file), os.X_OK)
+        # private download dirs are gone
+        assert [p.name for p in (tmp_path / "deps").iterdir()] == ["tool"]
+
+    def test_failed_download(self, mocker, tmp_path):
+        tool = self.tool(tmp_path / "deps")
+
+        def download(tmp_dir: Path) -> Path:
+            (tmp_dir / "tool").write_text("partial")
+            assert not tool.bin_file.exists()
+            raise CommandError("curl failed")
+
+        mocker.patch.object(self.Tool, "_download", side_effect=download)
+
+        with pytest.raises(CommandError):
+            tool.install()
+
+        assert list((tmp_path / "deps").iterdir()) == []
+
+    def test_cached(self, mocker, tmp_path):
+        def download(tmp_dir: Path) -> Path:
+            downloaded = tmp_dir / "tool"
+            downloaded.write_text("binary")
+            return downloaded
+
+        download_mock = mocker.patch.object(
+            self.Tool, "_download", side_effect=download
+        )
+
+        self.tool(tmp_path / "deps1").install()
+        tool = self.tool(tmp_path / "deps2")
+        tool.install()
+
+        download_mock.assert_called_once()
+        assert tool.bin_file.read_text() == "binary"
+
+    def test_install_deps(self):
+        barrier = Barrier(2, timeout=5)
+
+        cluster = Cluster.__new__(Cluster)
+        cluster.deps = [Mock(), Mock()]
+        for i, d in enumerate(cluster.deps):
+            d.name = f"dep{i}"
+            d.install.side_effect = barrier.wait
+
+        cluster.install_deps(workers=2)
+
+        for d in cluster.deps:
+            d.install.assert_called_once()
+
+    def test_install_deps_failed(self):
+        failing = Mock()
+        failing.name = "failing"
+        failing.install.side_effect = CommandError("curl failed")
+
+        queued = [Mock() for _ in range(5)]
+        for i, d in enumerate(queued):
+            d.name = f"queued{i}"
+            d.install.side_effect = lambda: time.sleep(0.2)
+
+        cluster = Cluster.__new__(Cluster)
+        cluster.deps = [failing] + queued
+
+        with pytest.raises(CommandError):
+            cluster.install_deps(workers=1)
+
+        # at most the one picked up before the failure was noticed
+        assert sum(d.install.called for d in queued) <= 1
+
+
+class TestProfiler:
+    @pytest.fixture
+    def prof(self, sandbox) -> Profiler:
+        p = profiler.enable()
+        yield p
+        profiler.disable()
+
+    def test_tree(self, prof):
+        with profiler.span("deploy"):
+            with ThreadPoolExecutor() as executor:
+                for f in [executor.submit(run, "echo app") for _ in range(2)]:
+                    f.result()
+
+        deploy = prof.root.children[0]
+        assert deploy.name == "deploy"
+        assert [c.name for c in deploy.children] == ["run echo app", "run echo app"]
+
+        tree = prof.format_tree().splitlines()
+        assert tree[1].endswith(" deploy")
+        assert tree[2].endswith(" run echo app (x2)")
+
+    def test_chrome_trace(self, prof, tmp_path):
+        with profiler.span("deploy", stage="test"):
+            pass
+
+        prof.save(tmp_path / "trace.json")
+        event = json.loads((tmp_path / "trace.json").read_text())["traceEvents"][0]
+
+        assert event["name"] == "deploy"
+        assert event["ph"] == "X"
+        assert event["args"] == {"stage": "test"}
+
+    def test_disabled(self):
+        assert profiler.get() is None
+        with profiler.span("deploy"):
+            pass
+
+    def test_secrets_redacted(self, sandbox):
+        prof = profiler.enable()
+        try:
+            run(
+                "echo docker login registry --username admin -psecret1\n"
+                "echo PGUSER=keycloak PGPASSWORD=secret2 psql\n"
+                "echo helm --password=secret3 --token secret4 && mkdir -p dir"
+            )
+        finally:
+            profiler.disable()
+
+        trace = json.dumps(prof.to_chrome_trace())
+        assert "secret" not in trace
+        assert "PGPASSWORD=***" in trace
+        assert "mkdir -p dir" in trace
+
+
+class TestDumps:
+    @pytest.fixture(autouse=True)
+    def fake_kubectl(self, sandbox, tmp_path, monkeypatch) -> None:
+        # runs the script passed to "kubectl exec" locally
+        bin_dir = tmp_path / "bin"
+        bin_dir.mkdir()
+        kubectl = bin_dir / "kubectl"
+        kubectl.write_text('#!/bin/bash\nexec bash -c "${@: -1}"\n')
+        kubectl.chmod(0o755)
+        monkeypatch.setenv("PATH", f"{str(bin_dir)}:{os.environ['PATH']}")
+
+    def test_dump_restore(self, tmp_path):
+        dst = tmp_path / "dumps/dump.sql.gz"
+        dumps.dump("aux", "postgres-0", "echo 'create table'", dst)
+
+        assert gzip.decompress(dst.read_bytes()) == b"create table\n"
+
+        out = tmp_path / "restored.sql"
+        dumps.restore("aux", "postgres-0", f"cat > {str(out)}", dst)
+        assert out.read_text() == "create table\n"
+
+    def test_failed_dump(self, tmp_path):
+        dst = tmp_path / "dump.sql.gz"
+        dst.write_text("previous")
+
+        with pytest.raises(CommandError) as exc:
+            dumps.dump("aux", "postgres-0", "echo partial; echo error >&2; false", dst)
+
+        assert str(exc.value) == "error"
+        assert dst.read_text() == "previous"
+        assert not (tmp_path / "dump.sql.gz.part").exists()
+
+    def test_failed_restore(self, tmp_path):
+        src = tmp_path / "dump.sql"
+        src.write_text("create table")
+
+        with pytest.raises(CommandError):
+            dumps.restore("aux", "postgres-0", "exit 1", src)
+
+
+class TestDockerDep:
+    class Dep(DockerDep):
+        name = "dep"
+        image_name = "dep/image"
+
+    @pytest.fixture
+    def docker(self, mocker) -> Mock:
+        docker = Mock()
+        docker.images.list.return_value = []
+        mocker.patch("docker.from_env", return_value=docker)
+        return docker
+
+    @pytest.mark.parametrize("compress", [False, True])
+    def test_round_trip(self, docker, tmp_path, compress):
+        if compress:
+            pytest.importorskip("zstandard")
+
+        payload = os.urandom(DockerDep.chunk_size * 2 + 100)
+        stream = BytesIO(payload)
+        chunks = iter(lambda: stream.read(DockerDep.chunk_size), b"")
+        docker.images.pull.return_value.save.return_value = chunks
+
+        dep = self.Dep(
+            self.Dep.Sets(deps_dir=tmp_path, version="1.0", compress=compress)
+        )
+        dep.install()
+
+        docker.images.pull.assert_called_once_with(repository="dep/image", tag="1.0")
+        docker.images.pull.return_value.save.assert_called_once_with(
+            chunk_size=DockerDep.chunk_size, named="dep/image:1.0"
+        )
+        assert dep.zst_file.exists() is compress
+        assert dep.tar_file.exists() is not compress
+        assert [p.name for p in tmp_path.iterdir()] == [
+            "dep.tar.zst" if compress else "dep.tar"
+        ]
+
+        loaded = []
+        docker.images.load.side_effect = lambda data: loaded.extend(data)
+
+        dep = self.Dep(
+            self.Dep.Sets(deps_dir=tmp_path, version="1.0", compress=compress)
+        )
+        dep.install()
+
+        docker.images.load.assert_called_once()
+        assert all(len(c) <= DockerDep.chunk_size for c in loaded)
+        assert b"".join(loaded) == payload
+
+    def test_image_loaded_only_if_missing(self, docker, tmp_path):
+        dep = self.Dep(self.Dep.Sets(deps_dir=tmp_path, version="1.0"))
+        dep.tar_file.write_bytes(b"tar")
+        docker.images.list.return_value = [Mock()]
+
+        dep.install()
+
+        docker.images.load.assert_not_called()
+        docker.images.pull.assert_not_called()
+
+
+class TestDnsServer:
+    @pytest.fixture
+    def dns_server(self, mocker, tmp_path, monkeypatch) -> DnsServer:
+        monkeypatch.setenv("HOME", str(tmp_path))
+        mocker.patch("docker.from_env")
+        mocker.patch.object(DnsServer, "is_running", return_value=False)
+        return DnsServer(DnsServer.Sets(deps_dir=tmp_path, version="2.19.0"))
+
+    def test_update_hosts(self, dns_server):
+        dns_server.update_hosts({"a.local": "172.18.0.2", "b.local": "172.18.0.2"})
+        dns_server.update_hosts({"b.local": "172.18.0.3", "c.local": "172.18.0.2"})
+
+        content = json.loads(dns_server.conf_file.read_text())
+        assert content["envs"][0]["hostnames"] == [
+            {"hostname": "b.local", "id": 2, "ip": "172.18.0.3", "ttl": 100000000},
+            {"hostname": "c.local", "id": 3, "ip": "172.18.0.2", "ttl": 100000000},
+        ]
+
+    def test_update_hosts_unchanged(self, dns_server, mocker):
+        dns_server.update_hosts({"a.local": "172.18.0.2"})
+        write_text = mocker.spy(Path, "write_text")
+
+        dns_server.update_hosts({"a.local": "172.18.0.2"})
+        write_text.assert_not_called()
+
+    def test_update_hosts_running(self, dns_server, mocker):
+        import requests
+
+        dns_server.update_hosts({"a.local": "172.18.0.2", "b.local": "172.18.0.2"})
+
+        mocker.patch.object(DnsServer, "is_running", return_value=True)
+        restart = mocker.patch.object(DnsServer, "restart")
+        container = dns_server.docker.containers.get.return_value
+        container.attrs = {"NetworkSettings": {"IPAddress": "172.17.0.5"}}
+        session = mocker.patch("requests.Session").return_value.__enter__.return_value
+
+        dns_server.update_hosts({"b.local": "172.18.0.3", "c.local": "172.18.0.2"})
+
+        url = "http://172.17.0.5:5380/hostname/"
+        session.put.assert_called_once_with(
+            url,
+            json={
+                "hostname": "b.local",
+                "id": 2,
+                "ip": "172.18.0.3",
+                "ttl": 100000000,
+                "env": "default",
+                "type": "A",
+            },
+            timeout=5,
+        )
+        session.post.assert_called_once_with(
+            url,
+            json={
+                "hostname": "c.local",
+                "id": 3,
+                "ip": "172.18.0.2",
+                "ttl": 100000000,
+                "env": "default",
+                "type": "A",
+            },
+            timeout=5,
+        )
+        session.delete.assert_called_once_with(
+            url, json={"env": "default", "hostname": "a.local"}, timeout=5
+        )
+        restart.assert_not_called()
+
+        # falls back to restarting when the api call fails
+        session.post.return_value.raise_for_status.side_effect = requests.HTTPError()
+        dns_server.update_hosts({"d.local": "172.18.0.2"})
+
+        restart.assert_called_once()
+        assert dns_server.get_hosts() == {"d.local": "172.18.0.2"}
+
+
+class TestImageBuilder:
+    @pytest.fixture
+    def dockerfile(self, sandbox, tmp_path) -> Dockerfile:
+        template = tmp_path / "Dockerfile.templ"
+        template.write_text("FROM {{ base_image }}")
+        context = tmp_path / "context"
+        context.mkdir()
+        (context / "main.py").write_text("print(1)")
+
+        return Dockerfile(
+            se=Dockerfile.Sets(
+                template=template,
+                out_path=tmp_path / "Dockerfile",
+                base_image="python:3.8",
+            ),
+            li=Dockerfile.Links(app_env=Mock(), cluster_env=Mock(root=context)),
+        )
+
+    def test_undefined_variables(self, dockerfile):
+        dockerfile.li.app_env = object()
+        dockerfile.se.template.write_text(
+            "FROM {{ base_image }}\nENV A={{ env.missing }}{{ missing }}"
+        )
+
+        assert dockerfile.render()
+        assert dockerfile.se.out_path.read_text() == "FROM python:3.8\nENV A="
+
+    def test_build(self, dockerfile, mocker, tmp_path):
+        pushed: List[str] = []
+
+        def run(command: str, **kwargs) -> List[str]:
+            if command.startswith("docker manifest inspect"):
+                if command.split()[-1] not in pushed:
+                    raise CommandError("no such manifest")
+            if command.startswith("docker push"):
+                pushed.append(command.split()[-1])
+            return []
+
+        run_mock = mocker.patch("pangea.apps.run", side_effect=run)
+        mocker.patch.object(apps, "_logged_in_registries", set())
+
+        def commands(prefix: str) -> List[str]:
+            return [c[0][0] for c in run_mock.call_args_list if prefix in c[0][0]]
+
+        def builder() -> ImageBuilder:
+            return ImageBuilder(
+                ImageBuilder.Sets(workers=2, index_file=tmp_path / "images.json"),
+                ImageBuilder.Links(registry_env=Mock()),
+            )
+
+        images = [builder().build(dockerfile, "registry/app") for _ in range(2)]
+        assert images[0].se.tag == images[1].se.tag
+        assert pushed == [images[0].se.tag]
+        assert len(commands("docker login")) == 1
+        # second build is skipped based on the local index
+        assert len(commands("docker manifest inspect")) == 1
+
+        builder().clear_index()
+        builder().build(dockerfile, "registry/app")
+        assert len(commands("docker manifest inspect")) == 2
+        assert len(pushed) == 1
+
+        (dockerfile.context_dir / "main.py").write_text("print(2)")
+        assert builder().build(dockerfile, "registry/app").se.tag != images[0].se.tag
+        assert len(pushed) == 2
+
+    def test_aliases(self, dockerfile, mocker, tmp_path):
+        local: List[str] = []
+        latest: List[str] = []
+
+        def run(command: str, **kwargs) -> List[str]:
+            if command.startswith("docker manifest inspect"):
+                raise CommandError("no such manifest")
+            if command.startswith("docker image inspect"):
+                if command.split()[-1] not in local:
+                    raise CommandError("no such image")
+            if command.strip().startswith("docker build"):
+                local.append(command.split()[-2])
+            if command.startswith("docker pull"):
+                local.append(command.split()[-1])
+            if command.startswith("docker tag"):
+                latest.append(command.split()[2])
+            return []
+
+        run_mock = mocker.patch("pangea.apps.run", side_effect=run)
+        mocker.patch.object(apps, "_logged_in_registries", set())
+
+        def build(content: str) -> str:
+            (dockerfile.context_dir / "main.py").write_text(content)
+            builder = ImageBuilder(
+                ImageBuilder.Sets(workers=2, index_file=tmp_path / "images.json"),
+                ImageBuilder.Links(registry_env=Mock()),
+            )
+            return builder.build(dockerfile, "registry/app", aliases=["latest"]).se.tag
+
+        a = build("print(1)")
+        b = build("print(2)")
+        # reverted, build is skipped but latest has to move back
+        assert build("print(1)") == a
+        assert latest == [a, b, a]
+
+        # built elsewhere, only in the registry
+        local.clear()
+        build("print(1)")
+        assert latest[-1] == a
+        assert f"docker pull {a}" in [c[0][0] for c in run_mock.call_args_list]
+
+    @pytest.fixture
+    def skaffold_app(self, dockerfile, mocker, tmp_path) -> SkaffoldApp:
+        (tmp_path / "values.yaml").write_text("replicas: 1")
+        env = Mock(
+            root=tmp_path,
+            stage="test",
+            image_name="registry/app",
+            base_image="python:3.8",
+            src=dockerfile.context_dir,
+            dockerfile_templ=dockerfile.se.template,
+        )
+        env.get_name.return_value = "app"
+
+        cluster = Mock()
+        cluster.image_builder = ImageBuilder(
+            ImageBuilder.Sets(workers=2, index_file=tmp_path / "images.json"),
+            ImageBuilder.Links(registry_env=Mock()),
+        )
+
+        app = SkaffoldApp(cluster=cluster, namespace=Namespace("flesh"), env=env)
+        mocker.patch.object(
+            SkaffoldApp, "render", lambda self: self.skaffold_file.write_text("")
+        )
+        mocker.patch.object(apps, "_logged_in_registries", set())
+        return app
+
+    def test_skaffold_deploy(self, skaffold_app, mocker):
+        base_manifest = ["base-1"]
+
+        def run(command: str, **kwargs) -> List[str]:
+            if command.startswith("docker manifest inspect"):
+                if command.endswith("python:3.8"):
+                    return base_manifest
+                raise CommandError("no such manifest")
+            return []
+
+        fingerprints: Dict[str, str] = {}
+
+        def kube_run(command: str, **kwargs) -> List[str]:
+            if command.startswith("kubectl get configmap"):
+                return [json.dumps({"data": fingerprints})]
+            if command.startswith("kubectl patch configmap"):
+                patch = json.loads(command.split("-p ")[1].strip("'"))
+                fingerprints.update(patch["data"])
+            return []
+
+        run_mock = mocker.patch("pangea.apps.run", side_effect=run)
+        mocker.patch("pangea.kube.run", side_effect=kube_run)
+
+        def deploys() -> int:
+            return len(
+                [c for c in run_mock.call_args_list if "skaffold deploy" in c[0][0]]
+            )
+
+        skaffold_app.deploy()
+        # skipping is opt in
+        skaffold_app.deploy()
+        assert deploys() == 2
+
+        with HelmRelease.skipping_unchanged():
+            skaffold_app.deploy()
+            assert deploys() == 2
+
+            # namespace was deleted along with the fingerprints
+            fingerprints.clear()
+            skaffold_app.deploy()
+            assert deploys() == 3
+
+            # base image rebuilt under the same tag
+            base_manifest[0] = "base-2"
+            skaffold_app.deploy()
+            assert deploys() == 4
+
+        builds = [
+            c[0][0] for c in run_mock.call_args_list if "skaffold build" in c[0][0]
+        ]
+        assert len(builds) == 2
+        build = builds[0]
+        assert "PL_IMAGE_NAME=registry/app PL_IMAGE_TAG=" in build
+        assert "PL_IMAGE_TAG" not in os.environ
+
+    def test_render_unchanged(self, dockerfile, mocker):
+        assert dockerfile.render()
+        write_text = mocker.spy(Path, "write_text")
+
+        assert not dockerfile.render()
+        write_text.assert_not_called()
+
+
+class TestDeployWaves:
+    @pytest.fixture
+    def cluster(self) -> Cluster:
+        # only what deploy waves need, no env or device
+        cluster = Cluster.__new__(Cluster)
+        cluster.namespaces = OrderedDict()
+        return cluster
+
+    def add_app(
+        self, cluster: Cluster, name: str, priority: int, deploy: Callable[[], None]
+    ) -> Mock:
+        app = Mock()
+        app.name = name
+        app.env.deploy_priority = priority
+        app.deploy.side_effect = deploy
+
+        namespace = cluster.namespaces.setdefault("system", Namespace("system"))
+        namespace.add_app_loader(name, Mock(return_value=app))
+        return app
+
+    def test_waves(self, cluster):
+        # both apps of the first wave have to be in flight at the same time
+        barrier = Barrier(2, timeout=5)
+        deployed: List[str] = []
+
+        def deploy(name: str) -> Callable[[], None]:
+            def ret() -> None:
+                if name != "ingress":
+                    barrier.wait()
+                deployed.append(name)
+
+            return ret
+
+        for name, priority in [("registry", 100), ("dns", 100), ("ingress", 200)]:
+            self.add_app(cluster, name, priority, deploy(name))
+
+        waves = cluster._get_deploy_waves()
+        assert [sorted(a.name for a in w) for w in waves] == [
+            ["dns", "registry"],
+            ["ingress"],
+        ]
+
+        for w in waves:
+            assert cluster._deploy_wave(w, fail_fast=True, workers=4) == []
+        assert deployed[-1] == "ingress"
+
+    def test_failures(self, cluster):
+        def fail() -> None:
+            raise CommandError("helm failed")
+
+        self.add_app(cluster, "registry", 100, fail)
+        ok = self.add_app(cluster, "dns", 100, lambda: None)
+        wave = cluster._get_deploy_waves()[0]
+
+        with pytest.raises(CommandError):
+            cluster._deploy_wave(wave, fail_fast=True, workers=1)
+
+        ok.deploy.reset_mock()
+        assert cluster._deploy_wave(wave, fail_fast=False, workers=1) == ["registry"]
+        ok.deploy.assert_called_once()
+
 
 class TestPangea:
     @pytest.fixture(autouse=True)
@@ -61,6 +1281,22 @@ class TestPangea:
         captured = capsys.readouterr()
         assert captured.out == "1.2.3\n"
 
+    def test_lazy_imports(self):
+        heavy = ["fire", "docker", "jinja2", "pexpect", "tqdm", "requests", "xonsh"]
+        code = (
+            "import sys, pangea.cluster;"
+            f"print(','.join(m for m in {heavy!r} if m in sys.modules))"
+        )
+        loaded = subprocess.run(
+            [sys.executable, "-c", code],
+            env={**os.environ, "PYTHONPATH": os.pathsep.join(sys.path)},
+            stdout=subprocess.PIPE,
+            check=True,
+            encoding="utf-8",
+        ).stdout.strip()
+
+        assert loaded == ""
+
     def test_init(self):
         assert Path("cluster.py").exists()
         assert Path("env_comm.py").exists()
@@ -107,6 +1343,13 @@ class TestCluster:
         assert (app_dir / "env_stage.py").exists()
         assert (app_dir / "env_prod.py").exists()
 
+    def test_deploy_waves(self, cluster, bootstrap, add_registry_app):
+        cluster.createapp("registry", "system", "registry")
+        cluster = utils.cluster()
+
+        waves = cluster._get_deploy_waves()
+        assert [[a.name for a in w] for w in waves] == [["registry"], ["ingress"]]
+
     def test_deploy(self, cluster, bootstrap, add_registry_app, cluster_ip):
         cluster.createapp("registry", "system", "registry")
         # we have to recreate cluster object due changing env_comm.py in registry_app fixture